@@ -1,31 +1,66 @@
-from json import loads
-from typing import Dict, List
+from collections import defaultdict
+from msgspec import ValidationError, convert
+from msgspec.json import Decoder
+from typing import Any, Dict, List
 from argparse import ArgumentParser
-from dacite import from_dict, Config
 
 from core.evaluator import evaluate
-from core.types import GenerationOutput
-from core.utils import print_scores, plot_perf_metrics
+from core.types import CompileStatus, DecodingStatus, GenerationOutput
+from core.utils import json_loads, print_scores, plot_perf_metrics
+
+decoder = Decoder(GenerationOutput)
+
+
+def decode_output(line: bytes) -> GenerationOutput:
+    try:
+        output = decoder.decode(line)
+    except ValidationError:
+        output = convert(_replace_nulls(json_loads(line)), GenerationOutput, strict=False)
+
+    # a missing status is reported like a status that was never set
+    metadata = output.metadata
+    if metadata.compile_status is None:
+        metadata.compile_status = CompileStatus()
+    if metadata.decoding_status is None:
+        metadata.decoding_status = DecodingStatus()
+    return output
+
+
+def _replace_nulls(data: Dict[str, Any]) -> Dict[str, Any]:
+    # outputs saved by older versions can hold nulls where a value is now
+    # expected, which are replaced by the field's empty value; a null
+    # generation is kept, so that the output is not scored
+    if data.get("generated_tokens") is None:
+        data["generated_tokens"] = []
+    for key in ("token_usage", "perf_metrics", "metadata"):
+        if data.get(key) is None:
+            data[key] = {}
+    data["token_usage"] = {
+        name: count or 0 for name, count in data["token_usage"].items()
+    }
+    return data
+
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--outputs", type=str, required=True)
     parser.add_argument("--details", action="store_true")
+    parser.add_argument(
+        "--eval_workers",
+        type=int,
+        default=None,
+        help="processes validating the generations of a task",
+    )
     args = parser.parse_args()
 
-    dacite_config = Config(check_types=False)
-    with open(args.outputs, "r") as f:
-        engine_config = loads(f.readline())
-        outputs = [
-            from_dict(GenerationOutput, loads(line), config=dacite_config)
-            for line in f.readlines()[0:]
-        ]
+    with open(args.outputs, "rb") as f:
+        engine_config = json_loads(f.readline())
+        outputs = [decode_output(line) for line in f]
 
-    task_outputs: Dict[str, List[GenerationOutput]] = {}
+    task_outputs: Dict[str, List[GenerationOutput]] = defaultdict(list)
     for output in outputs:
-        if output.task not in task_outputs:
-            task_outputs[output.task] = []
         task_outputs[output.task].append(output)
+    task_names = list(task_outputs)
 
     compliance = []
     perf_metrics = []
@@ -33,7 +68,7 @@ if __name__ == "__main__":
     declared_coverage = []
     empirical_coverage = []
     for outputs in task_outputs.values():
-        dc, ec, cl, pm, ot, _ = evaluate(outputs)
+        dc, ec, cl, pm, ot, _ = evaluate(outputs, max_workers=args.eval_workers)
 
         compliance.append(cl)
         perf_metrics.append(pm)
@@ -48,14 +83,14 @@ if __name__ == "__main__":
         compliance,
         perf_metrics,
         output_tokens,
-        list(task_outputs.keys()),
+        task_names,
         args.details,
     )
 
     if args.details:
         plot_perf_metrics(
             perf_metrics,
-            list(task_outputs.keys()),
+            task_names,
             f"{args.outputs.split('.')[0]}.png",
             engine_config["engine"],
         )
@@ -1,20 +1,51 @@
-import os
 import sys
+import queue
 import threading
 from pathlib import Path
 from tqdm import tqdm
-from json import dumps
-from dataclasses import asdict
-from typing import List, Optional, Union
+from msgspec.json import Encoder
+from functools import partial
+from typing import Callable, List, Optional, Union
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 from core.engine import Engine
 from core.evaluator import evaluate
 from core.types import GenerationOutput
 from core.dataset import Dataset, DatasetConfig
-from core.utils import disable_print, nanoid, safe_min, print_scores, save_evaluation_results_to_csv, upload_to_s3
+from core.utils import disable_print, nanoid, print_scores, save_evaluation_results_to_csv, upload_to_s3
 from core.messages import MessagesFormatter, FEW_SHOTS_MESSAGES_FORMATTER
 
-write_lock = threading.Lock() 
+json_encoder = Encoder()
+
+SAVE_BUFFER_SIZE = 1 << 20
+
+# Result persistence (CSV rows and S3 uploads) is handed to a single background
+# thread. Jobs run in submission order, so a task's CSV row is always written
+# before the upload that reads it, and the CSV file has a single writer.
+results_queue: "queue.Queue[Callable[[], None]]" = queue.Queue()
+_results_worker: Optional[threading.Thread] = None
+_results_worker_lock = threading.Lock()
+
+
+def _run_results_worker() -> None:
+    while True:
+        job = results_queue.get()
+        try:
+            job()
+        except Exception as e:
+            print(f"Error while saving results: {e}")
+        finally:
+            results_queue.task_done()
+
+
+def submit_results_job(job: Callable[[], None]) -> None:
+    global _results_worker
+    with _results_worker_lock:
+        if _results_worker is None:
+            _results_worker = threading.Thread(target=_run_results_worker, daemon=True)
+            _results_worker.start()
+    results_queue.put(job)
+
 
 def bench(
     engine: Engine,
@@ -25,7 +56,11 @@ def bench(
     ] = FEW_SHOTS_MESSAGES_FORMATTER,
     close_engine: bool = True,
     save_outputs: bool = False,
-    output_path: Optional[str] = "outputs"
+    output_path: Optional[str] = "outputs",
+    max_workers: int = 8,
+    use_batch_api: bool = False,
+    return_outputs: bool = True,
+    eval_workers: Optional[int] = None,
 ) -> List[List[GenerationOutput]]:
     """Benchmarks an engine with specified tasks and datasets.
 
@@ -46,26 +81,44 @@ def bench(
         Whether to save the generation outputs after the benchmark.
     :param output_path: Optional[str]
         where to save the generation results
+    :param max_workers: int
+        The number of samples generated concurrently for engines that are
+        marked as thread safe. Other engines always generate sequentially.
+    :param use_batch_api: bool
+        Whether to submit all the samples of a task at once through the
+        engine's `generate_batch` method, for engines backed by a provider
+        batch API. The outputs then have no performance metrics.
+    :param return_outputs: bool
+        Whether to keep the generation outputs of every task in memory to
+        return them. Callers that only need the saved outputs can disable it,
+        so that each task's outputs are released once written.
+    :param eval_workers: Optional[int]
+        The number of worker processes checking the outputs of a task against
+        their schemas, or None to check them in this process.
 
     :return: List[List[GenerationOutput]]
-        The generation outputs for each sample for each task.
+        The generation outputs for each sample for each task, or an empty
+        list if `return_outputs` is disabled.
     """
+    if use_batch_api and not hasattr(engine, "generate_batch"):
+        raise ValueError(f"Engine {engine.name} does not support the batch API")
+
     id = nanoid()
     
     if save_outputs:
         output_path = Path(output_path)
         engine_dir = output_path / engine.name
-        engine_dir.mkdir(parents=True, exist_ok=True)
 
         if engine.name == "openai_compatible":
-            provider_dir = engine_dir / engine.config.provider
-            provider_dir.mkdir(parents=True, exist_ok=True)
-            save_json_output_path = provider_dir / f"{engine.config.model.replace('/', '_')}.jsonl"
+            save_dir = engine_dir / engine.config.provider
+            save_json_output_path = save_dir / f"{engine.config.model.replace('/', '_')}.jsonl"
         else:
-            save_json_output_path = engine_dir / f"{id}.jsonl"
+            save_dir = engine_dir
+            save_json_output_path = save_dir / f"{id}.jsonl"
+        save_dir.mkdir(parents=True, exist_ok=True)
 
-        with open(save_json_output_path, "w") as f:
-            f.write(f"{dumps({'engine': engine.name, 'engine_config': asdict(engine.config)})}\n")
+        save_file = open(save_json_output_path, "wb", buffering=SAVE_BUFFER_SIZE)
+        save_file.write(json_encoder.encode_lines([{"engine": engine.name, "engine_config": engine.config}]))
     
 
     if not isinstance(messages_formatter, list):
@@ -78,53 +131,59 @@ def bench(
     declared_coverage = []
     empirical_coverage = []
     
-    for task, mf in zip(tasks, messages_formatter):
-        print(f"# Running Task {task} for engine {engine.name}, with provider {getattr(engine.config, 'provider', 'n/a')} for model {getattr(engine.config, 'model', 'n/a')}")
-        task_outputs = []
-        dataset = Dataset(DatasetConfig(task, limit=limit))
-        for messages, schema in tqdm(
-            dataset.iter(mf),
-            total=safe_min(len(dataset), limit),
-            desc=task,
-            file=sys.stdout,
-            #TODO add thread_id
-        ):
-            with disable_print(): # comment to debug
-                schema = engine.adapt_schema(schema)
-                result = engine.generate(task, messages, schema)
-                task_outputs.append(result)
+    try:
+        for task, mf in zip(tasks, messages_formatter):
+            print(f"# Running Task {task} for engine {engine.name}, with provider {getattr(engine.config, 'provider', 'n/a')} for model {getattr(engine.config, 'model', 'n/a')}")
+            dataset = Dataset(DatasetConfig(task, limit=limit))
+            if use_batch_api:
+                task_outputs = engine.generate_batch(task, list(dataset.iter(mf)))
+            else:
+                task_outputs = generate_task_outputs(
+                    engine, task, dataset, mf, max_workers
+                )
         
-        dc, ec, cl, pm, ot, evaluated_outputs = evaluate(task_outputs)
-        declared_coverage.append(dc)
-        empirical_coverage.append(ec)
-        compliance.append(cl)
-        perf_metrics.append(pm)
-        output_tokens.append(ot)
+            dc, ec, cl, pm, ot, evaluated_outputs = evaluate(task_outputs, max_workers=eval_workers)
+            # only the evaluated outputs are kept for the caller; release the
+            # task's schemas and raw output list before the next task loads
+            del dataset, task_outputs
+            declared_coverage.append(dc)
+            empirical_coverage.append(ec)
+            compliance.append(cl)
+            perf_metrics.append(pm)
+            output_tokens.append(ot)
         
-        if save_outputs:
-            with open(save_json_output_path, "a") as f:
-                for output in evaluated_outputs:
-                    f.write(f"{dumps(asdict(output))}\n")
-                    
-            results_path = engine_dir / "eval_results.csv"
-            save_evaluation_results_to_csv(
-                csv_path=results_path,
-                run_id=output_path.name or id,
-                provider = getattr(engine.config, "provider", "n/a"),
-                model = getattr(engine.config, "model", "n/a"),
-                task=task,
-                dc=dc,
-                ec=ec,
-                cl=cl,
-                pm=pm,  
-                ot=ot,
-                write_lock=write_lock
-            )
-            s3_path=f"fc-so-testing-suite/jsonschemabench_snova/{'/'.join(results_path.parts[-3:])}"
-            upload_to_s3(results_path, s3_path)
+            if save_outputs:
+                save_file.write(json_encoder.encode_lines(evaluated_outputs))
+                save_file.flush()
+
+                results_path = engine_dir / "eval_results.csv"
+                submit_results_job(
+                    partial(
+                        save_evaluation_results_to_csv,
+                        csv_path=results_path,
+                        run_id=output_path.name or id,
+                        provider = getattr(engine.config, "provider", "n/a"),
+                        model = getattr(engine.config, "model", "n/a"),
+                        task=task,
+                        dc=dc,
+                        ec=ec,
+                        cl=cl,
+                        pm=pm,
+                        ot=ot,
+                    )
+                )
+                s3_path=f"fc-so-testing-suite/jsonschemabench_snova/{'/'.join(results_path.parts[-3:])}"
+                submit_results_job(partial(upload_to_s3, results_path, s3_path))
             
-        all_outputs.append(evaluated_outputs)
+            if return_outputs:
+                all_outputs.append(evaluated_outputs)
+            del evaluated_outputs
         
+    finally:
+        if save_outputs:
+            save_file.close()
+        results_queue.join()
+
     print_scores(
         declared_coverage,
         empirical_coverage,
@@ -138,3 +197,69 @@ def bench(
         engine.close()
 
     return all_outputs
+
+
+def generate_task_outputs(
+    engine: Engine,
+    task: str,
+    dataset: Dataset,
+    messages_formatter: MessagesFormatter,
+    max_workers: int,
+) -> List[GenerationOutput]:
+    """Generates the outputs for every sample of a task, in dataset order.
+
+    Engines marked as thread safe are called from a thread pool so that
+    network-bound generations overlap; others are called one at a time.
+    """
+    # the dataset already applies the limit and its length is a list length
+    total = len(dataset)
+    # redraw the progress bar at most ~200 times per task
+    progress_kwargs = dict(
+        total=total,
+        desc=task,
+        file=sys.stdout,
+        miniters=max(1, total // 200),
+        mininterval=0.2,
+    )
+
+    if not engine.thread_safe or max_workers <= 1:
+        task_outputs = []
+        for messages, schema in tqdm(
+            dataset.iter(messages_formatter), **progress_kwargs
+        ):
+            with disable_print(): # comment to debug
+                task_outputs.append(engine.generate(task, messages, schema))
+        return task_outputs
+
+    # only a window of samples is in flight, refilled as generations complete,
+    # so that the samples are formatted lazily instead of all being queued
+    # upfront; disable_print swaps the process-wide streams, so it must wrap
+    # the whole pool rather than each worker call
+    window = 2 * max_workers
+    samples = dataset.iter(messages_formatter)
+    task_outputs: List[Optional[GenerationOutput]] = [None] * total
+    pending = {}
+    progress = tqdm(**progress_kwargs)
+    try:
+        with disable_print(), ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                for index, (messages, schema) in enumerate(samples):
+                    if len(pending) >= window:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            task_outputs[pending.pop(future)] = future.result()
+                        progress.update(len(done))
+                    pending[executor.submit(engine.generate, task, messages, schema)] = index
+
+                for future in wait(pending).done:
+                    task_outputs[pending[future]] = future.result()
+                progress.update(len(pending))
+            finally:
+                # when a generation fails, the queued samples are dropped so
+                # that the error propagates once the running ones finish
+                for future in pending:
+                    future.cancel()
+    finally:
+        progress.close()
+
+    return task_outputs
@@ -1,9 +1,11 @@
-from json import loads
+import random
+from functools import lru_cache
 from dataclasses import dataclass
 from datasets import load_dataset
 from typing import Callable, Iterator, Tuple, Optional, List
 
 from core.types import Schema
+from core.utils import json_loads
 from core.messages import Message, MessagesFormatter
 
 DATASET_SCHEMA_COLUMN = "json_schema"
@@ -24,6 +26,37 @@ DATASET_NAMES = [
 ]
 
 
+@lru_cache(maxsize=2 * len(DATASET_NAMES))
+def load_rows(dataset_name: str, limit: Optional[int] = None) -> Tuple[str, ...]:
+    """Loads the raw JSON schemas of a dataset once per process, so that
+    benchmarking several engines on a dataset only reads it once.
+
+    :param dataset_name: str
+        The name of the dataset.
+    :param limit: Optional[int]
+        The number of schemas to load, all of them if None.
+    :return: Tuple[str, ...]
+        The schemas, serialized as JSON.
+    """
+    if limit is None:
+        return tuple(
+            load_dataset(path=DATASET_HUGGINGFACE_PATH, name=dataset_name, split="test")[
+                DATASET_SCHEMA_COLUMN
+            ]
+        )
+
+    # stream only the first `limit` rows instead of materializing the split
+    return tuple(
+        row[DATASET_SCHEMA_COLUMN]
+        for row in load_dataset(
+            path=DATASET_HUGGINGFACE_PATH,
+            name=dataset_name,
+            split="test",
+            streaming=True,
+        ).take(limit)
+    )
+
+
 @dataclass
 class DatasetConfig:
     dataset_name: str
@@ -38,39 +71,32 @@ class Dataset:
             The configuration for the dataset.
         """
         self.config = config
-        self._full_dataset = load_dataset(
-            path=DATASET_HUGGINGFACE_PATH, name=config.dataset_name, split="test"
-        )
-        
-        # Apply limit here
-        self.dataset = (
-            self._full_dataset
-            if config.limit is None
-            else self._full_dataset.select(range(min(config.limit, len(self._full_dataset))))
-        )
+
+        # schemas are parsed once here and shared by every accessor below;
+        # engines may adapt them in place, so each dataset parses its own;
+        # json_loads keeps the integers past 64 bits that orjson turns into
+        # floats, so schemas and prompts match their source text
+        self._schemas: List[Schema] = [
+            json_loads(row) for row in load_rows(config.dataset_name, config.limit)
+        ]
 
     def __len__(self):
-        return len(self.dataset)
+        return len(self._schemas)
 
     def __getitem__(self, idx: int) -> Schema:
-        return loads(self.dataset[idx][DATASET_SCHEMA_COLUMN])
+        return self._schemas[idx]
 
     def filter(self, filter_fn: Callable[[Schema], bool]) -> None:
-        self.dataset = self.dataset.filter(
-            lambda x: filter_fn(loads(x[DATASET_SCHEMA_COLUMN]))
-        )
+        self._schemas = [schema for schema in self._schemas if filter_fn(schema)]
 
     def map(self, map_fn: Callable[[Schema], Schema]) -> None:
-        self.dataset = self.dataset.map(
-            lambda x: map_fn(loads(x[DATASET_SCHEMA_COLUMN]))
-        )
+        self._schemas = [map_fn(schema) for schema in self._schemas]
 
     def shuffle(self) -> None:
-        self.dataset = self.dataset.shuffle()
+        random.shuffle(self._schemas)
 
     def iter(
         self, messages_formatter: MessagesFormatter
     ) -> Iterator[Tuple[List[Message], Schema]]:
-        for item in self.dataset:
-            schema = loads(item[DATASET_SCHEMA_COLUMN])
+        for schema in self._schemas:
             yield messages_formatter(self.config.dataset_name, schema), schema
@@ -1,10 +1,14 @@
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
 from abc import ABC, abstractmethod
-from typing import List, Optional, TypeVar, Generic
+from typing import Any, Dict, List, Optional, TypeVar, Generic
 
 from core.messages import Message
 from core.profile import profile_generation
+from core.utils import canonical_json_dumps
 from core.types import (
+    Token,
     Schema,
     TokenUsage,
     GenerationOutput,
@@ -18,9 +22,14 @@ class EngineConfig:
 
 T = TypeVar("T", bound=EngineConfig)
 
+# adapted schemas kept per engine, least recently used first out
+MAX_ADAPTED_SCHEMAS = 1024
+
 
 class Engine(ABC, Generic[T]):
     name: str
+    # whether `generate` can be called concurrently from several threads
+    thread_safe: bool = False
 
     def __init__(self, config: T):
         """Defines the interface that should be implemented by all engines.
@@ -34,6 +43,14 @@ class Engine(ABC, Generic[T]):
 
         self.config = config
         self.total_usage = TokenUsage()
+        self._usage_lock = threading.Lock()
+        self._adapted_schemas: "OrderedDict[bytes, Schema]" = OrderedDict()
+        self._adapted_schemas_lock = threading.Lock()
+        # compiled artifacts (grammars, generators...) keyed by schema
+        # fingerprint, for engines that can reuse them across samples
+        self._compiled_schemas: Dict[bytes, Any] = {}
+        # ids of streamed token strings, which repeat heavily across samples
+        self._token_ids: Dict[str, Optional[int]] = {}
 
     @profile_generation
     def generate(
@@ -57,14 +74,15 @@ class Engine(ABC, Generic[T]):
             The generation output.
         """
 
-        schema = self.adapt_schema(schema)
+        schema = self._adapt_schema_cached(schema)
         output = GenerationOutput(
             task=task, messages=messages, generation="", schema=schema
         )
 
         self._generate(output)
 
-        self.total_usage += output.token_usage
+        with self._usage_lock:
+            self.total_usage += output.token_usage
         return output
 
     @abstractmethod
@@ -103,6 +121,43 @@ class Engine(ABC, Generic[T]):
         """
         return schema
 
+    def _adapt_schema_cached(self, schema: Schema) -> Schema:
+        """Adapts the schema once per distinct schema content. Identical
+        schemas, compared by their canonical JSON serialization, reuse the
+        previously adapted schema while it is among the last
+        `MAX_ADAPTED_SCHEMAS` used.
+
+        :param schema: Schema
+            The schema to adapt.
+        :return: Schema
+            The adapted schema.
+        """
+        key = self.schema_fingerprint(schema)
+        with self._adapted_schemas_lock:
+            adapted = self._adapted_schemas.get(key)
+            if adapted is not None:
+                self._adapted_schemas.move_to_end(key)
+                return adapted
+
+        adapted = self.adapt_schema(schema)
+        with self._adapted_schemas_lock:
+            self._adapted_schemas[key] = adapted
+            if len(self._adapted_schemas) > MAX_ADAPTED_SCHEMAS:
+                self._adapted_schemas.popitem(last=False)
+        return adapted
+
+    @staticmethod
+    def schema_fingerprint(schema: Schema) -> bytes:
+        """Returns a canonical serialization of the schema, equal for schemas
+        with the same content regardless of key order.
+
+        :param schema: Schema
+            The schema to fingerprint.
+        :return: bytes
+            The fingerprint of the schema.
+        """
+        return canonical_json_dumps(schema)
+
     def encode(self, text: str) -> Optional[List[int]]:
         """Encodes a text string into a list of tokens.
 
@@ -131,8 +186,13 @@ class Engine(ABC, Generic[T]):
         :return: Optional[int]
             The id of the token.
         """
+        try:
+            return self._token_ids[token]
+        except KeyError:
+            pass
         res = self.encode(token)
-        return res[0] if res else None
+        id = self._token_ids[token] = res[0] if res else None
+        return id
 
     def convert_id_to_token(self, id: int) -> Optional[str]:
         """Converts an id to a token.
@@ -145,6 +205,24 @@ class Engine(ABC, Generic[T]):
         res = self.decode([id])
         return res[0] if res else None
 
+    def tokens_from_chunks(
+        self, chunks: List[str], ids: Optional[List[int]] = None
+    ) -> List[Token]:
+        """Pairs streamed text chunks with their token ids. When the ids of
+        the whole generation line up one to one with the chunks they are used
+        directly, otherwise each chunk is converted on its own.
+
+        :param chunks: List[str]
+            The streamed text chunks.
+        :param ids: Optional[List[int]]
+            The ids of the concatenated chunks, if already encoded.
+        :return: List[Token]
+            The generated tokens.
+        """
+        if ids is not None and len(ids) == len(chunks):
+            return [Token(id=id, text=text) for id, text in zip(ids, chunks)]
+        return [Token(id=self.convert_token_to_id(text), text=text) for text in chunks]
+
     def count_tokens(self, text: str) -> int:
         """Counts the number of tokens in a text string. This can be
         implemented by the engines if they don't provide a tokenizer.
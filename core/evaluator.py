@@ -1,11 +1,14 @@
+import os
+import re
 import numpy as np
-from uuid import UUID
-from json import loads
-from typing import List, Tuple
-from ipaddress import IPv4Address, IPv6Address
+from functools import lru_cache
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, Optional, Tuple
+from ipaddress import IPv6Address
 from jsonschema import Draft202012Validator, FormatChecker, SchemaError
 
-from core.utils import bootstrap
+from core.utils import bootstrap_mean, canonical_json_dumps, json_loads
 from core.types import (
     Schema,
     CompileStatusCode,
@@ -14,8 +17,33 @@ from core.types import (
     Metric,
 )
 
+try:
+    import jsonschema_rs
+except ImportError:
+    jsonschema_rs = None
+
+# set JSONSCHEMA_VALIDATOR=jsonschema_rs to validate with the Rust
+# implementation when it is installed; it is much faster than jsonschema
+_VALIDATOR_IMPL = os.getenv("JSONSCHEMA_VALIDATOR", "jsonschema")
+if _VALIDATOR_IMPL == "jsonschema_rs" and jsonschema_rs is None:
+    _VALIDATOR_IMPL = "jsonschema"
+
 
 def is_json_schema_valid(schema: Schema):
+    return _is_schema_key_valid(canonical_json_dumps(schema))
+
+
+# schemas repeat across samples and engines check them again after adapting,
+# so the meta-schema check is done once per canonical serialization
+@lru_cache(maxsize=1024)
+def _is_schema_key_valid(schema_key: bytes) -> bool:
+    schema = json_loads(schema_key)
+    if _VALIDATOR_IMPL == "jsonschema_rs":
+        try:
+            return jsonschema_rs.meta.is_valid(schema)
+        except Exception:
+            return False
+
     try:
         Draft202012Validator.check_schema(schema)
         return True
@@ -26,106 +54,179 @@ def is_json_schema_valid(schema: Schema):
 format_checker = FormatChecker()
 
 
+_IPV4_OCTET = r"(?:25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9]?[0-9])"
+_IPV4_PATTERN = re.compile(rf"{_IPV4_OCTET}(?:\.{_IPV4_OCTET}){{3}}")
+_UUID_PATTERN = re.compile(r"[0-9a-fA-F]{8}-(?:[0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}")
+
+
+# format checks return whether the value is valid; like the built-in checks,
+# they only apply to strings
 @format_checker.checks("ipv4")
-def ipv4_check(value):
-    IPv4Address(value)
+def ipv4_check(value) -> bool:
+    return not isinstance(value, str) or _IPV4_PATTERN.fullmatch(value) is not None
 
 
 @format_checker.checks("ipv6")
-def ipv6_check(value):
-    IPv6Address(value)
+def ipv6_check(value) -> bool:
+    if not isinstance(value, str):
+        return True
+    try:
+        IPv6Address(value)
+    except ValueError:
+        return False
+    return True
 
 
 @format_checker.checks("uuid")
-def uuid_check(value):
-    UUID(value)
+def uuid_check(value) -> bool:
+    return not isinstance(value, str) or _UUID_PATTERN.fullmatch(value) is not None
+
+
+@lru_cache(maxsize=512)
+def _build_validator(schema_key: bytes) -> Optional[Any]:
+    if not _is_schema_key_valid(schema_key):
+        return None
+
+    schema = json_loads(schema_key)
+
+    if _VALIDATOR_IMPL == "jsonschema_rs":
+        return jsonschema_rs.Draft202012Validator(
+            schema,
+            formats={
+                "ipv4": ipv4_check,
+                "ipv6": ipv6_check,
+                "uuid": uuid_check,
+            },
+            validate_formats=True,
+        )
+    return Draft202012Validator(schema, format_checker=format_checker)
+
+
+def get_validator(schema: Schema) -> Optional[Any]:
+    """Returns the validator for a schema, or None if the schema itself is not
+    valid. Validators are built once per distinct schema content and reused.
+    """
+    return _build_validator(canonical_json_dumps(schema))
 
 
 def validate_json_schema(instance: Schema, schema: Schema) -> bool:
-    if not is_json_schema_valid(schema):
+    validator = get_validator(schema)
+    if validator is None:
         return False
-    validator = Draft202012Validator(schema, format_checker=format_checker)
+    # is_valid stops at the first error without building a ValidationError;
+    # we still catch errors raised by extension validators
     try:
-        validator.validate(instance)
-
-    # we catch all exceptions include ValidationError and Error from extension validators
+        return validator.is_valid(instance)
     except Exception:
         return False
-    return True
+
+
+_OK = CompileStatusCode.OK
+
+
+def _evaluate_output(
+    generation_output: GenerationOutput,
+) -> Tuple[GenerationOutput, Optional[int], Optional[int]]:
+    """Checks a single output against its schema and records the failure, if
+    any, in its metadata.
+
+    :return: Tuple[GenerationOutput, Optional[int], Optional[int]]
+        The evaluated output with its declared and empirical coverage, which
+        are None when the output has no generation or schema.
+    """
+    generation = generation_output.generation
+    schema = generation_output.schema
+    metadata = generation_output.metadata
+
+    if schema is None or generation is None:
+        metadata.failure=True
+        metadata.failure_type="Empty generation or schema"
+        return generation_output, None, None
+
+    declared_coverage = 1 if metadata.compile_status.code == _OK else 0
+
+    try:
+        json_object = json_loads(generation)
+    except Exception:
+        metadata.failure=True
+        metadata.failure_type="Generation is not json parsable"
+        return generation_output, declared_coverage, 0
+
+    if not validate_json_schema(json_object, schema):
+        metadata.failure=True
+        metadata.failure_type="Generated json is not instance of the provided schema"
+        return generation_output, declared_coverage, 0
+
+    metadata.failure=False
+    return generation_output, declared_coverage, 1
 
 
 def evaluate(
     outputs: List[GenerationOutput],
+    max_workers: Optional[int] = None,
 ) -> Tuple[Metric, Metric, Metric, AggregatedPerfMetrics, Metric, List[GenerationOutput]]:
-    output_tokens_list = []
-    declared_coverage_list = []
-    empirical_coverage_list = []
+    """Evaluates the generation outputs of a task.
+
+    :param outputs: List[GenerationOutput]
+        The generation outputs to evaluate.
+    :param max_workers: Optional[int]
+        If greater than 1, outputs are checked in that many worker processes.
+        The returned outputs are then copies of the given ones.
+    :return: Tuple[Metric, Metric, Metric, AggregatedPerfMetrics, Metric, List[GenerationOutput]]
+        The declared coverage, empirical coverage, compliance, performance
+        metrics, output tokens and the evaluated outputs.
+    """
+    n = len(outputs)
+    # -1 marks outputs without a generation or schema, which are not scored
+    declared_coverage = np.full(n, -1, dtype=np.int8)
+    empirical_coverage = np.full(n, -1, dtype=np.int8)
+    output_tokens = np.zeros(n, dtype=np.int64)
+    # ttft, tpot, tgt and gct of each output, NaN when missing
+    perf = np.empty((n, 4), dtype=np.float64)
     evaluated_outputs = []
 
-    for generation_output in outputs:
-        generation = generation_output.generation
-        schema = generation_output.schema
-
-        if schema is None or generation is None:
-            generation_output.metadata.failure=True
-            generation_output.metadata.failure_type="Empty generation or schema"
-            evaluated_outputs.append(generation_output)
+    if max_workers is not None and max_workers > 1 and n > 1:
+        # forking after numba's parallel bootstrap has started its thread pool
+        # can deadlock the workers, so they are spawned instead
+        with ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=get_context("spawn")
+        ) as executor:
+            results = list(
+                executor.map(
+                    _evaluate_output,
+                    outputs,
+                    chunksize=max(1, n // (4 * max_workers)),
+                )
+            )
+    else:
+        results = map(_evaluate_output, outputs)
+
+    append_output = evaluated_outputs.append
+    for i, (generation_output, dc, ec) in enumerate(results):
+        append_output(generation_output)
+        pm = generation_output.perf_metrics
+        perf[i] = (pm.ttft, pm.tpot, pm.tgt, pm.gct)
+        if dc is None:
             continue
 
-        if generation_output.metadata.compile_status.code == CompileStatusCode.OK:
-            declared_coverage_list.append(1)
-        else:
-            declared_coverage_list.append(0)
+        declared_coverage[i] = dc
+        empirical_coverage[i] = ec
+        if ec:
+            output_tokens[i] = generation_output.token_usage.output_tokens
 
-        try:
-            json_object = loads(generation)
-        except Exception:
-            empirical_coverage_list.append(0)
-            generation_output.metadata.failure=True
-            generation_output.metadata.failure_type="Generation is not json parsable"
-            evaluated_outputs.append(generation_output)
-            continue
+    ttft_list, tpot_list, tgt_list, gct_list = (
+        column[~np.isnan(column)].tolist() for column in perf.T
+    )
 
-        if not validate_json_schema(json_object, schema):
-            empirical_coverage_list.append(0)
-            generation_output.metadata.failure=True
-            generation_output.metadata.failure_type="Generated json is not instance of the provided schema"
-            evaluated_outputs.append(generation_output)
-            continue
+    scored = declared_coverage >= 0
+    declared_coverage = declared_coverage[scored]
+    empirical_coverage = empirical_coverage[scored]
+    compliance = empirical_coverage[declared_coverage == 1]
+    output_tokens_list = output_tokens[scored][empirical_coverage == 1].tolist()
 
-        empirical_coverage_list.append(1)
-        generation_output.metadata.failure=False
-        evaluated_outputs.append(generation_output)
-        output_tokens_list.append(generation_output.token_usage.output_tokens)
-
-    ttft_list = [
-        generation_output.perf_metrics.ttft
-        for generation_output in outputs
-        if generation_output.perf_metrics.ttft is not None
-    ]
-    tpot_list = [
-        generation_output.perf_metrics.tpot
-        for generation_output in outputs
-        if generation_output.perf_metrics.tpot is not None
-    ]
-    tgt_list = [
-        generation_output.perf_metrics.tgt
-        for generation_output in outputs
-        if generation_output.perf_metrics.tgt is not None
-    ]
-    gct_list = [
-        generation_output.perf_metrics.gct
-        for generation_output in outputs
-        if generation_output.perf_metrics.gct is not None
-    ]
-
-    compliance_list = [
-        ec for ec, dc in zip(empirical_coverage_list, declared_coverage_list) if dc == 1
-    ]
-
-    dc_mean_list = bootstrap(declared_coverage_list, np.mean)
-    ec_mean_list = bootstrap(empirical_coverage_list, np.mean)
-    c_mean_list = bootstrap(compliance_list, np.mean)
+    dc_mean_list = bootstrap_mean(declared_coverage)
+    ec_mean_list = bootstrap_mean(empirical_coverage)
+    c_mean_list = bootstrap_mean(compliance)
 
     return (
         Metric.from_values(dc_mean_list),
@@ -9,35 +9,19 @@ MessagesFormatter = Callable[[str, "Schema"], List[Message]]
 
 
 def few_shots_messages_formatter(task: str, schema: "Schema", num_shots: int = None) -> List[Message]:
-    examples = [
-        example
-        for key, examples in EXAMPLES_FOR_TASK.items()
-        if task in key
-        for example in examples
-    ]
+    prefix = PREFIX_FOR_TASK.get(task, DEFAULT_PREFIX)
+    num_examples = (len(prefix) - 1) // 2
 
     # Important to be explicit below, because num_shots CAN BE 0.
     if num_shots is not None: 
-        assert num_shots <= len(examples), (
+        assert num_shots <= num_examples, (
             f"num_shots ({num_shots}) cannot be greater than the number of examples for task {task} "
-            f"({len(examples)})"
+            f"({num_examples})"
         )
     else:
-        num_shots = min(len(examples), 5)
+        num_shots = min(num_examples, 5)
 
-    messages = [
-        {
-            "role": "system",
-            "content": "You need to generate a JSON object that matches the schema below.",
-        }
-    ]
-
-    for input, output in examples[:num_shots]:
-        messages.append({"role": "user", "content": input})
-        messages.append({"role": "assistant", "content": output})
-
-    messages.append({"role": "user", "content": dumps(schema)})
-    return messages
+    return [*prefix[: 1 + 2 * num_shots], {"role": "user", "content": dumps(schema)}]
 
 
 EXAMPLES_FOR_TASK: Dict[Tuple[str], List[Tuple[str, str]]] = {
@@ -104,4 +88,31 @@ EXAMPLES_FOR_TASK: Dict[Tuple[str], List[Tuple[str, str]]] = {
     ("default",): [],
 }
 
+SYSTEM_MESSAGE: Message = {
+    "role": "system",
+    "content": "You need to generate a JSON object that matches the schema below.",
+}
+
+
+def _build_prefix(examples: List[Tuple[str, str]]) -> List[Message]:
+    prefix = [SYSTEM_MESSAGE]
+    for input, output in examples:
+        prefix.append({"role": "user", "content": input})
+        prefix.append({"role": "assistant", "content": output})
+    return prefix
+
+
+def _build_prefixes() -> Dict[str, List[Message]]:
+    examples_for_task: Dict[str, List[Tuple[str, str]]] = {}
+    for key, examples in EXAMPLES_FOR_TASK.items():
+        for task in key:
+            examples_for_task.setdefault(task, []).extend(examples)
+    return {task: _build_prefix(examples) for task, examples in examples_for_task.items()}
+
+
+# the system message followed by all the example turns of each task, built
+# once; formatting a prompt only slices a prefix and appends the schema
+PREFIX_FOR_TASK: Dict[str, List[Message]] = _build_prefixes()
+DEFAULT_PREFIX: List[Message] = [SYSTEM_MESSAGE]
+
 FEW_SHOTS_MESSAGES_FORMATTER: MessagesFormatter = few_shots_messages_formatter
@@ -1,4 +1,4 @@
-from time import time
+from time import perf_counter_ns, time
 from functools import wraps
 from typing import Callable, Dict, Any, TYPE_CHECKING, List
 
@@ -18,9 +18,12 @@ def profile_generation(
     def wrapper(
         engine: "Engine", task: str, messages: List[Message], schema: Dict[str, Any]
     ) -> "GenerationOutput":
+        # engines timestamp their events with time(), so the start is anchored
+        # to the wall clock while the duration comes from the monotonic clock
         gen_start_time: float = time()
+        gen_start_ns: int = perf_counter_ns()
         output: "GenerationOutput" = generate(engine, task, messages, schema)
-        gen_end_time: float = time()
+        gen_end_time: float = gen_start_time + (perf_counter_ns() - gen_start_ns) / 1e9
 
         perf_metrics: PerfMetrics = PerfMetrics.from_timestamps(
             start_time=gen_start_time,
@@ -1,12 +1,28 @@
-from typing import Dict, Type, TYPE_CHECKING
+from types import MappingProxyType
+from typing import Dict, Mapping, Type, TYPE_CHECKING
 
 if TYPE_CHECKING:
     from core.engine import Engine, EngineConfig
 
-ENGINE_TO_CLASS: Dict[str, Type["Engine"]] = {}
-ENGINE_TO_CONFIG: Dict[str, Type["EngineConfig"]] = {}
+_CLASSES: Dict[str, Type["Engine"]] = {}
+_CONFIGS: Dict[str, Type["EngineConfig"]] = {}
+_frozen = False
+
+# read-only views over the registered engines
+ENGINE_TO_CLASS: Mapping[str, Type["Engine"]] = MappingProxyType(_CLASSES)
+ENGINE_TO_CONFIG: Mapping[str, Type["EngineConfig"]] = MappingProxyType(_CONFIGS)
 
 
 def register_engine(engine_class: Type["Engine"], config_class: Type["EngineConfig"]):
-    ENGINE_TO_CLASS[engine_class.name] = engine_class
-    ENGINE_TO_CONFIG[engine_class.name] = config_class
+    if _frozen:
+        raise RuntimeError(
+            f"Cannot register engine {engine_class.name}: the registry is frozen"
+        )
+    _CLASSES[engine_class.name] = engine_class
+    _CONFIGS[engine_class.name] = config_class
+
+
+def freeze_registry() -> None:
+    """Prevents further engine registrations once startup is complete."""
+    global _frozen
+    _frozen = True
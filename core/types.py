@@ -1,11 +1,13 @@
-import numpy as np
 from enum import Enum
-from uuid import uuid4
+import os
+import secrets
+from itertools import count
+from msgspec import Struct, field as struct_field
 from dataclasses import dataclass, field
 from typing import List, Dict, Any, Optional
 
 from core.messages import Message
-from core.utils import safe_divide, safe_subtract, safe_reduce
+from core.utils import summarize
 
 
 Schema = Dict[str, Any]
@@ -32,20 +34,17 @@ class DecodingStatusCode(int, Enum):
     UNKOWN_ERROR = 4
 
 
-@dataclass
-class CompileStatus:
+class CompileStatus(Struct, gc=False):
     code: CompileStatusCode = CompileStatusCode.TBD
     message: Optional[str] = None
 
 
-@dataclass
-class DecodingStatus:
+class DecodingStatus(Struct, gc=False):
     code: DecodingStatusCode = DecodingStatusCode.TBD
     message: Optional[str] = None
 
 
-@dataclass
-class TokenUsage:
+class TokenUsage(Struct, gc=False):
     input_tokens: int = 0
     output_tokens: int = 0
 
@@ -61,25 +60,30 @@ class TokenUsage:
         )
 
 
-@dataclass
-class Token:
+# structs holding only scalars can't be part of reference cycles, so they are
+# not tracked by the garbage collector; this matters for the per-token objects
+class Token(Struct, gc=False):
     id: Optional[int] = None
     text: Optional[str] = None
     logprob: Optional[float] = None
 
 
-@dataclass
-class GenerationMetadata:
+class GenerationMetadata(Struct):
     first_token_arrival_time: Optional[float] = None
     grammar_compilation_end_time: Optional[float] = None
+    # whether the grammar was reused from an earlier compilation
+    grammar_cached: bool = False
     failure: Optional[bool] = None
     failure_type: Optional[str] = None
-    compile_status: Optional[CompileStatus] = field(default_factory=CompileStatus)
-    decoding_status: Optional[DecodingStatus] = field(default_factory=DecodingStatus)
+    compile_status: Optional[CompileStatus] = struct_field(
+        default_factory=CompileStatus
+    )
+    decoding_status: Optional[DecodingStatus] = struct_field(
+        default_factory=DecodingStatus
+    )
 
 
-@dataclass
-class PerfMetrics:
+class PerfMetrics(Struct, gc=False):
     """Performance metrics for generation processes."""
 
     # Time to first token in s
@@ -104,28 +108,24 @@ class PerfMetrics:
         end_time: float,
         num_output_tokens: int,
     ):
-        ttft = safe_subtract(first_token_arrival_time, start_time)
+        # inlined equivalents of the safe_* helpers, this runs for every output
+        first = first_token_arrival_time
+        compiled = grammar_compilation_end_time
         tpot = (
-            safe_divide(
-                safe_subtract(end_time, first_token_arrival_time),
-                safe_subtract(num_output_tokens, 1),
-            )
-            if num_output_tokens > 0
+            (end_time - first) / (num_output_tokens - 1) * 1000
+            if first is not None and num_output_tokens > 1
             else None
         )
-        tgt = safe_subtract(end_time, start_time)
-        gct = safe_subtract(grammar_compilation_end_time, start_time)
-        prft = safe_subtract(first_token_arrival_time, grammar_compilation_end_time)
         return cls(
-            ttft=ttft,
-            tpot=tpot * 1000 if tpot is not None else None,
-            tgt=tgt,
-            gct=gct,
-            prft=prft,
+            ttft=first - start_time if first is not None else None,
+            tpot=tpot,
+            tgt=end_time - start_time,
+            gct=compiled - start_time if compiled is not None else None,
+            prft=first - compiled if first is not None and compiled is not None else None,
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class Metric:
     values: List[float] = field(default_factory=list)
     min: Optional[float] = None
@@ -135,16 +135,21 @@ class Metric:
 
     @classmethod
     def from_values(cls, values: List[float]) -> "Metric":
-        return cls(
-            values=values,
-            min=safe_reduce(values, min),
-            max=safe_reduce(values, max),
-            median=safe_reduce(values, np.median),
-            std=safe_reduce(values, np.std),
-        )
+        metric = cls(values=values)
+        metric.finalize()
+        return metric
+
+    def finalize(self) -> None:
+        """Computes the summary statistics of the values in a single pass. It
+        should be called again if the values are changed."""
+        if not len(self.values):
+            self.min = self.max = self.median = self.std = None
+            return
 
+        self.median, self.min, self.max, self.std = summarize(self.values)
 
-@dataclass
+
+@dataclass(slots=True)
 class AggregatedPerfMetrics:
     ttft: Metric = field(default_factory=Metric)
     tpot: Metric = field(default_factory=Metric)
@@ -153,16 +158,32 @@ class AggregatedPerfMetrics:
     prft: Metric = field(default_factory=Metric)
 
 
-@dataclass
-class GenerationOutput:
+# generation ids are a random per-process prefix followed by a counter, which
+# is unique across runs and much cheaper than a uuid4 per output
+_ID_PREFIX = secrets.token_hex(4)
+_ID_COUNTER = count()
+
+
+def _reset_id_prefix() -> None:
+    # forked processes must not reuse the parent's prefix and counter
+    global _ID_PREFIX, _ID_COUNTER
+    _ID_PREFIX = secrets.token_hex(4)
+    _ID_COUNTER = count()
+
+
+os.register_at_fork(after_in_child=_reset_id_prefix)
+
+
+class GenerationOutput(Struct):
     """Output of a generation run."""
 
     task: str
     messages: List[Message]
-    generation: str
+    # None when an output saved by an older version had no generation
+    generation: Optional[str]
     schema: Schema
-    id: str = field(default_factory=lambda: str(uuid4()))
-    generated_tokens: List[Token] = field(default_factory=list)
-    token_usage: TokenUsage = field(default_factory=TokenUsage)
-    perf_metrics: PerfMetrics = field(default_factory=PerfMetrics)
-    metadata: GenerationMetadata = field(default_factory=GenerationMetadata)
+    id: str = struct_field(default_factory=lambda: f"{_ID_PREFIX}-{next(_ID_COUNTER):x}")
+    generated_tokens: List[Token] = struct_field(default_factory=list)
+    token_usage: TokenUsage = struct_field(default_factory=TokenUsage)
+    perf_metrics: PerfMetrics = struct_field(default_factory=PerfMetrics)
+    metadata: GenerationMetadata = struct_field(default_factory=GenerationMetadata)
@@ -1,18 +1,23 @@
 import os
+import re
 import sys
+import copy
+import json
+import orjson
+import atexit
 import random
+import signal
 import string
+import warnings
 import numpy as np
-from dacite import from_dict
-from omegaconf import OmegaConf
-import matplotlib.pyplot as plt
-from prettytable import PrettyTable
+from time import perf_counter
+from functools import lru_cache
 from contextlib import contextmanager
-from typing import List, Optional, TypeVar, Type, TYPE_CHECKING, Callable
+from typing import IO, Any, Dict, Iterable, List, Optional, Tuple, TypeVar, Type, TYPE_CHECKING, Callable, Union
 import csv
+import fcntl
 import threading
 from pathlib import Path
-import boto3
 
 if TYPE_CHECKING:
     from core.types import Metric, AggregatedPerfMetrics
@@ -25,28 +30,35 @@ T = TypeVar("T")
 
 
 def load_config(config_type: Type[T], config_path: str) -> T:
-    return from_dict(data_class=config_type, data=OmegaConf.load(config_path))
+    from dacite import from_dict
+
+    # configs are mutable, so every call builds its own copy of the data
+    path = os.path.abspath(config_path)
+    data = _load_config_data(path, os.stat(path).st_mtime_ns)
+    return from_dict(data_class=config_type, data=copy.deepcopy(data))
+
+
+@lru_cache(maxsize=128)
+def _load_config_data(path: str, _mtime_ns: int) -> Dict[str, Any]:
+    """Parses a config file once per modification time."""
+    from omegaconf import OmegaConf
+
+    return OmegaConf.to_container(OmegaConf.load(path), resolve=True)
 
 
 def safe_divide(a: Optional[float], b: Optional[float]) -> Optional[float]:
     """Safely divides a by b, returning None if either input is None."""
-    if a is None or b is None or b == 0:
-        return None
-    return a / b
+    return None if a is None or b is None or b == 0 else a / b
 
 
 def safe_subtract(a: Optional[float], b: Optional[float]) -> Optional[float]:
     """Safely subtracts b from a, returning None if either input is None."""
-    if a is None or b is None:
-        return None
-    return a - b
+    return None if a is None or b is None else a - b
 
 
 def safe_min(a: int, b: Optional[int]) -> int:
     """Safely finds the minimum of a and b, returning a if b is None."""
-    if b is None:
-        return a
-    return min(a, b)
+    return a if b is None else min(a, b)
 
 
 def safe_reduce(a: List[T], func: Callable[[List[T]], T]) -> Optional[T]:
@@ -54,6 +66,32 @@ def safe_reduce(a: List[T], func: Callable[[List[T]], T]) -> Optional[T]:
     return func(a) if a else None
 
 
+def median(values: List[float]) -> Optional[float]:
+    """Computes the median of a list of values, returning None if it is empty.
+    The middle values are selected with a partition instead of a full sort."""
+    arr = np.asarray(values, dtype=np.float64)
+    n = arr.size
+    if n == 0:
+        return None
+    k = n // 2
+    if n % 2:
+        return float(np.partition(arr, k)[k])
+    part = np.partition(arr, (k - 1, k))
+    return float((part[k - 1] + part[k]) / 2)
+
+
+def summarize(values: List[float]) -> Tuple[float, float, float, float]:
+    """Computes the median, min, max and standard deviation of a non-empty list
+    of values. A single partition of the data gives the median and the extremes
+    without sorting it."""
+    arr = np.asarray(values, dtype=np.float64)
+    n = arr.size
+    k = n // 2
+    part = np.partition(arr, (0, max(k - 1, 0), k, n - 1))
+    median = part[k] if n % 2 else (part[k - 1] + part[k]) / 2
+    return float(median), float(part[0]), float(part[n - 1]), float(arr.std())
+
+
 def format_metric(metric: "Metric", details: bool = False) -> str:
     if (
         metric.median is None
@@ -67,26 +105,179 @@ def format_metric(metric: "Metric", details: bool = False) -> str:
     )
 
 
+# the streams are process-wide, so overlapping disable_print blocks (e.g.
+# benchmarks running in several threads) share one swap: the first block to
+# enter silences them and the last one to exit restores them
+_print_lock = threading.Lock()
+_print_depth = 0
+_print_streams = None
+
+
 @contextmanager
 def disable_print():
-    stdout = sys.stdout
-    stderr = sys.stderr
-    sys.stdout = open(os.devnull, "w")
-    sys.stderr = open(os.devnull, "w")
+    global _print_depth, _print_streams
+    with _print_lock:
+        if _print_depth == 0:
+            _print_streams = (sys.stdout, sys.stderr)
+            sys.stdout = open(os.devnull, "w")
+            sys.stderr = sys.stdout
+        _print_depth += 1
+    try:
+        yield
+    finally:
+        with _print_lock:
+            _print_depth -= 1
+            if _print_depth == 0:
+                sys.stdout.close()
+                sys.stdout, sys.stderr = _print_streams
+                _print_streams = None
+
+
+_warned_thread_timeout = False
+
+
+@contextmanager
+def alarm_timeout(seconds: float):
+    """Raises TimeoutError inside the block once `seconds` have elapsed.
+    Uses a single SIGALRM timer, so it only interrupts the block on the main
+    thread; elsewhere the block runs to completion and TimeoutError is raised
+    after it if it took longer than `seconds`, so that its result is still
+    reported as timed out."""
+    if threading.current_thread() is not threading.main_thread():
+        global _warned_thread_timeout
+        if not _warned_thread_timeout:
+            _warned_thread_timeout = True
+            warnings.warn(
+                "timeouts can't interrupt work outside the main thread, they "
+                "are only checked once it completes",
+                RuntimeWarning,
+                stacklevel=3,
+            )
+        start = perf_counter()
+        yield
+        if perf_counter() - start >= seconds:
+            raise TimeoutError
+        return
+
+    def handler(*_):
+        raise TimeoutError
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
     try:
         yield
     finally:
-        sys.stdout = stdout
-        sys.stderr = stderr
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+# orjson parses integers past 64 bits as floats and rejects NaN, Infinity and
+# out of range floats, which json accepts; texts that may hold any of them are
+# parsed by json, so that both give the same values
+_LONG_NUMBER = re.compile(r"\d{19,}")
+_LONG_NUMBER_BYTES = re.compile(rb"\d{19,}")
+
+
+def json_loads(data: Union[str, bytes]) -> Any:
+    """Parses JSON with orjson, or with json when orjson would lose or reject
+    a number."""
+    pattern = _LONG_NUMBER_BYTES if isinstance(data, bytes) else _LONG_NUMBER
+    if pattern.search(data) is None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def canonical_json_dumps(obj: Any) -> bytes:
+    """Serializes JSON with sorted keys, with json when orjson can't, e.g. for
+    integers past 64 bits."""
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj, sort_keys=True).encode()
+
+
+_LETTERS = string.ascii_letters.encode()
 
 
 def nanoid(length: int = 4) -> str:
-    return "".join(random.choices(string.ascii_letters, k=length))
+    # keep the low 6 bits of random bytes and reject the ones past the 52
+    # letters, so each letter is equally likely
+    letters = bytearray()
+    while len(letters) < length:
+        for byte in os.urandom(2 * length):
+            index = byte & 63
+            if index < 52:
+                letters.append(_LETTERS[index])
+    return letters[:length].decode()
+
+
+_rng = np.random.default_rng()
+
+# set BOOTSTRAP_BACKEND=numba to draw the bootstrap resamples with numba
+# kernels when it is installed; they run in parallel but draw different
+# resamples than NumPy
+_BOOTSTRAP_BACKEND = os.getenv("BOOTSTRAP_BACKEND", "numpy")
+
+
+@lru_cache(maxsize=None)
+def _bootstrap_kernels() -> Dict[Callable, Callable[[np.ndarray, int, int], np.ndarray]]:
+    """Numba-compiled bootstrap kernels for the common statistics, keyed by the
+    NumPy function they compute. Each resample is drawn from its own seed,
+    derived from the given one, so the results don't depend on how the
+    resamples are spread over threads. Empty unless the numba backend is
+    selected and installed."""
+    if _BOOTSTRAP_BACKEND != "numba":
+        return {}
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return {}
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def bootstrap_mean_kernel(data, n_samples, seed):
+        n = data.size
+        stats = np.empty(n_samples)
+        for i in prange(n_samples):
+            np.random.seed(seed + i)
+            stats[i] = data[np.random.randint(0, n, n)].mean()
+        return stats
+
+    @njit(parallel=True, cache=True)
+    def bootstrap_median_kernel(data, n_samples, seed):
+        n = data.size
+        stats = np.empty(n_samples)
+        for i in prange(n_samples):
+            np.random.seed(seed + i)
+            stats[i] = np.median(data[np.random.randint(0, n, n)])
+        return stats
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def bootstrap_std_kernel(data, n_samples, seed):
+        n = data.size
+        stats = np.empty(n_samples)
+        for i in prange(n_samples):
+            np.random.seed(seed + i)
+            stats[i] = data[np.random.randint(0, n, n)].std()
+        return stats
+
+    return {
+        np.mean: bootstrap_mean_kernel,
+        np.median: bootstrap_median_kernel,
+        np.std: bootstrap_std_kernel,
+    }
 
 
 def bootstrap(
     data: List[float], func: Callable[[List[float]], float], n_samples: int = 100
 ) -> List[float]:
+    kernel = _bootstrap_kernels().get(func)
+    if kernel is not None and len(data) > 0:
+        seed = int(_rng.integers(0, 2**31 - n_samples))
+        return kernel(np.asarray(data, dtype=np.float64), n_samples, seed).tolist()
+
     samples = []
     for _ in range(n_samples):
         sample = random.choices(data, k=len(data))
@@ -94,6 +285,26 @@ def bootstrap(
     return samples
 
 
+def bootstrap_mean(data: List[float], n_samples: int = 100) -> List[float]:
+    """Same as `bootstrap(data, np.mean, n_samples)`, with all the resamples
+    drawn and averaged at once, by numba if selected or by NumPy."""
+    n = len(data)
+    if n == 0:
+        return [float("nan")] * n_samples
+
+    kernel = _bootstrap_kernels().get(np.mean)
+    if kernel is not None:
+        seed = int(_rng.integers(0, 2**31 - n_samples))
+        return kernel(np.asarray(data, dtype=np.float64), n_samples, seed).tolist()
+
+    values = np.asarray(data)
+    if values.dtype.kind in "biu" and values.min() >= 0 and values.max() <= 1:
+        # coverage lists are made of 0/1 flags
+        values = values.astype(np.int8)
+    indices = _rng.integers(0, n, size=(n_samples, n), dtype=np.int32)
+    return values[indices].mean(axis=1).tolist()
+
+
 def print_scores(
     declared_coverage: List["Metric"],
     empirical_coverage: List["Metric"],
@@ -103,6 +314,8 @@ def print_scores(
     tasks: List[str],
     details: bool = False,
 ) -> None:
+    from prettytable import HRuleStyle, PrettyTable
+
     columns = [
         "Task",
         "Declared coverage",
@@ -115,16 +328,8 @@ def print_scores(
         "Output tokens",
     ]
 
-    table = PrettyTable(columns)
-    for task, dc, ec, cl, pm, ot in zip(
-        tasks,
-        declared_coverage,
-        empirical_coverage,
-        compliance,
-        perf_metrics,
-        output_tokens,
-    ):
-        row = [
+    rows = [
+        [
             task,
             format_metric(dc, details),
             format_metric(ec, details),
@@ -135,8 +340,21 @@ def print_scores(
             format_metric(pm.gct, details),
             format_metric(ot, details),
         ]
+        for task, dc, ec, cl, pm, ot in zip(
+            tasks,
+            declared_coverage,
+            empirical_coverage,
+            compliance,
+            perf_metrics,
+            output_tokens,
+        )
+    ]
 
-        table.add_row(row, divider=details)
+    # with details, every row is followed by a divider
+    table = PrettyTable(
+        columns, hrules=HRuleStyle.ALL if details else HRuleStyle.FRAME
+    )
+    table.add_rows(rows)
     print(table)
 
 
@@ -152,7 +370,6 @@ def save_evaluation_results_to_csv(
     cl: Optional["Metric"] = None,
     pm: Optional["AggregatedPerfMetrics"] = None,
     ot: Optional["Metric"] = None,
-    write_lock = threading.Lock() 
 ):
     row = {
         "run_id": run_id,
@@ -169,13 +386,41 @@ def save_evaluation_results_to_csv(
         "output_tokens": format_metric(ot),
     }
 
-    with write_lock:
-        file_exists = os.path.exists(csv_path)
-        with open(csv_path, "a", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=row.keys(), delimiter=';')
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(row)
+    with _CSV_WRITE_LOCK:
+        f, writer = _get_csv_writer(csv_path)
+        # processes benchmarking other providers append to the same file, so
+        # the header check and the row are written under a file lock
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.fstat(f.fileno()).st_size == 0:
+                writer.writerow(row.keys())
+            writer.writerow(row.values())
+            # the file is uploaded right after each row, so it must be complete
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# results CSV files are kept open for the whole run, by path, and written
+# under a single lock
+_CSV_WRITE_LOCK = threading.Lock()
+_CSV_HANDLES: Dict[str, Tuple[IO[str], Any]] = {}
+
+
+def _get_csv_writer(csv_path: str) -> Tuple[IO[str], Any]:
+    key = os.fspath(csv_path)
+    if key not in _CSV_HANDLES:
+        f = open(key, "a", newline="")
+        _CSV_HANDLES[key] = (f, csv.writer(f, delimiter=";"))
+    return _CSV_HANDLES[key]
+
+
+@atexit.register
+def _close_csv_handles() -> None:
+    for f, _ in _CSV_HANDLES.values():
+        f.close()
+    _CSV_HANDLES.clear()
+
 
 def plot_perf_metrics(
     perf_metrics: List["AggregatedPerfMetrics"],
@@ -183,21 +428,16 @@ def plot_perf_metrics(
     path: str,
     engine_name: str,
 ) -> None:
+    # a standalone Figure renders with Agg when saved to png, independently of
+    # the pyplot backend and its global figure state
+    from matplotlib.figure import Figure
+
     metric_names = ["TTFT", "TPOT", "TGT", "GCT"]
 
     valid_tasks = []
     valid_metrics = []
     for task, pm in zip(tasks, perf_metrics):
-        if (
-            pm.ttft
-            and pm.ttft.values
-            or pm.tpot
-            and pm.tpot.values
-            or pm.tgt
-            and pm.tgt.values
-            or pm.gct
-            and pm.gct.values
-        ):
+        if any(metric and metric.values for metric in (pm.ttft, pm.tpot, pm.tgt, pm.gct)):
             valid_tasks.append(task)
             valid_metrics.append(pm)
 
@@ -205,45 +445,47 @@ def plot_perf_metrics(
         print("No valid metrics data found for any task.")
         return
 
-    fig, axs = plt.subplots(
+    fig = Figure(
+        figsize=(5 * len(metric_names), 4 * len(valid_tasks)), layout="constrained"
+    )
+    axs = fig.subplots(
         nrows=len(valid_tasks),
         ncols=len(metric_names),
-        figsize=(5 * len(metric_names), 4 * len(valid_tasks)),
         sharex="col",
     )
 
     if len(valid_tasks) == 1:
         axs = np.array([axs])
 
-    all_metrics_data = {
-        "TTFT": [],
-        "TPOT": [],
-        "TGT": [],
-        "GCT": [],
-    }
+    # the values of every metric for every task, as float arrays
+    tasks_metrics_data = [
+        {
+            metric_name: np.asarray(
+                metric.values if metric and metric.values else [], dtype=np.float64
+            )
+            for metric_name, metric in zip(
+                metric_names, (pm.ttft, pm.tpot, pm.tgt, pm.gct)
+            )
+        }
+        for pm in valid_metrics
+    ]
 
-    for pm in valid_metrics:
-        all_metrics_data["TTFT"].extend(
-            pm.ttft.values if pm.ttft and pm.ttft.values else []
-        )
-        all_metrics_data["TPOT"].extend(
-            pm.tpot.values if pm.tpot and pm.tpot.values else []
-        )
-        all_metrics_data["TGT"].extend(
-            pm.tgt.values if pm.tgt and pm.tgt.values else []
-        )
-        all_metrics_data["GCT"].extend(
-            pm.gct.values if pm.gct and pm.gct.values else []
-        )
+    # mean and median of every non-empty (task, metric) cell
+    stats = {
+        (i, metric_name): (values.mean(), median(values))
+        for i, metrics_data in enumerate(tasks_metrics_data)
+        for metric_name, values in metrics_data.items()
+        if values.size
+    }
 
+    # bins shared by all the tasks, 20 edges spanning all the values of a metric
     bin_intervals = {}
     for metric_name in metric_names:
-        if all_metrics_data[metric_name]:
-            bin_intervals[metric_name] = np.linspace(
-                min(all_metrics_data[metric_name]),
-                max(all_metrics_data[metric_name]),
-                20,
-            )
+        all_values = np.concatenate(
+            [metrics_data[metric_name] for metrics_data in tasks_metrics_data]
+        )
+        if all_values.size:
+            bin_intervals[metric_name] = np.histogram_bin_edges(all_values, bins=19)
         else:
             bin_intervals[metric_name] = None
 
@@ -251,18 +493,11 @@ def plot_perf_metrics(
         unit = "ms" if metric_name == "TPOT" else "seconds"
         axs[0, j].set_title(f"{metric_name} ({unit})", fontsize=14)
 
-    for i, (task, pm) in enumerate(zip(valid_tasks, valid_metrics)):
+    for i, (task, metrics_data) in enumerate(zip(valid_tasks, tasks_metrics_data)):
         axs[i, 0].set_ylabel(task, fontsize=12, rotation=45, ha="right")
 
-        metrics_data = {
-            "TTFT": pm.ttft.values if pm.ttft and pm.ttft.values else [],
-            "TPOT": pm.tpot.values if pm.tpot and pm.tpot.values else [],
-            "TGT": pm.tgt.values if pm.tgt and pm.tgt.values else [],
-            "GCT": pm.gct.values if pm.gct and pm.gct.values else [],
-        }
-
         for j, metric_name in enumerate(metric_names):
-            if metrics_data[metric_name]:
+            if metrics_data[metric_name].size:
                 if bin_intervals[metric_name] is not None:
                     axs[i, j].hist(
                         metrics_data[metric_name],
@@ -273,11 +508,7 @@ def plot_perf_metrics(
                     )
                 else:
                     if len(metrics_data[metric_name]) > 1:
-                        bins = np.linspace(
-                            min(metrics_data[metric_name]),
-                            max(metrics_data[metric_name]),
-                            20,
-                        )
+                        bins = np.histogram_bin_edges(metrics_data[metric_name], bins=19)
                     else:
                         value = metrics_data[metric_name][0]
                         bins = np.linspace(max(0, value * 0.9), value * 1.1, 20)
@@ -294,8 +525,7 @@ def plot_perf_metrics(
                     axs[i, j].set_xlabel(f"Value ({unit})")
 
                 if len(metrics_data[metric_name]) > 0:
-                    mean_val = np.mean(metrics_data[metric_name])
-                    median_val = np.median(metrics_data[metric_name])
+                    mean_val, median_val = stats[i, metric_name]
                     axs[i, j].axvline(
                         mean_val,
                         color="red",
@@ -328,17 +558,19 @@ def plot_perf_metrics(
                     bin_intervals[metric_name][0], bin_intervals[metric_name][-1]
                 )
 
-    fig.suptitle(f"Performance Metrics for {engine_name}", fontsize=16, y=0.99)
-    plt.tight_layout()
-    plt.subplots_adjust(top=0.95, wspace=0.3, hspace=0.4)
+    fig.suptitle(f"Performance Metrics for {engine_name}", fontsize=16)
+    fig.get_layout_engine().set(wspace=0.05, hspace=0.05)
 
-    plt.savefig(path, dpi=300, bbox_inches="tight")
-    plt.close()
+    fig.savefig(path, dpi=150)
 
     print(f"Saved plot to {path}")
 
 
+# boto3 clients are thread safe, a single one is shared by all the S3 helpers
+@lru_cache(maxsize=1)
 def get_s3_client():
+    import boto3
+
     s3 = boto3.client(
         "s3",
         region_name=os.getenv("AWS_REGION", ""),
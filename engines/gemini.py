@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from typing import Optional, List
 
 from core.types import Schema
@@ -6,6 +7,14 @@ from core.registry import register_engine
 from core.evaluator import is_json_schema_valid
 from engines.openai import OpenAIEngine, OpenAIConfig
 
+MAX_CONTEXT_LENGTHS = {
+    "models/gemini-2.0-flash": 1_048_576,
+    "models/gemini-2.0-flash-lite": 1_048_576,
+    "models/gemini-1.5-flash": 1_048_576,
+    "models/gemini-1.5-flash-8b": 1_048_576,
+    "models/gemini-1.5-pro": 2_097_152,
+}
+
 
 class GeminiEngine(OpenAIEngine):
     name = "gemini"
@@ -21,6 +30,8 @@ class GeminiEngine(OpenAIEngine):
 
         configure(api_key=os.getenv("GEMINI_API_KEY"))
         self.model = GenerativeModel(model_name=self.config.model)
+        # counting is a request to the API, so repeated texts are cached
+        self._count_tokens = lru_cache(maxsize=4096)(self._count_tokens_remote)
 
     def encode(self, _: str) -> Optional[List[int]]:
         return None
@@ -29,33 +40,26 @@ class GeminiEngine(OpenAIEngine):
         return None
 
     def count_tokens(self, text: str) -> int:
+        return self._count_tokens(text)
+
+    def _count_tokens_remote(self, text: str) -> int:
         return self.model.count_tokens(text).total_tokens
 
     def adapt_schema(self, schema: Schema) -> Schema:
         required_fields = schema.get("required", [])
-        if "id" not in required_fields:
-            schema.pop("id", None)
-        if "title" not in required_fields:
-            schema.pop("title", None)
-        if "$schema" not in required_fields:
-            schema.pop("$schema", None)
-        if "$id" not in required_fields:
-            schema.pop("$id", None)
-
-        if not is_json_schema_valid(schema):
+        changed = False
+        for key in ("id", "title", "$schema", "$id"):
+            if key not in required_fields and key in schema:
+                del schema[key]
+                changed = True
+
+        if changed and not is_json_schema_valid(schema):
             print("The JSON schema after adaptation is no longer valid.")
         return schema
 
     @property
     def max_context_length(self) -> int:
-        max_context_length_dict = {
-            "models/gemini-2.0-flash": 1_048_576,
-            "models/gemini-2.0-flash-lite": 1_048_576,
-            "models/gemini-1.5-flash": 1_048_576,
-            "models/gemini-1.5-flash-8b": 1_048_576,
-            "models/gemini-1.5-pro": 2_097_152,
-        }
-        return max_context_length_dict[self.config.model]
+        return MAX_CONTEXT_LENGTHS[self.config.model]
 
 
 register_engine(GeminiEngine, OpenAIConfig)
@@ -1,6 +1,6 @@
-import stopit
 from time import time
 from typing import List, Optional
+from functools import cached_property
 from dataclasses import dataclass
 
 from core.registry import register_engine
@@ -8,7 +8,7 @@ from engines.llama_cpp import LlamaCppConfig
 from core.engine import Engine, EngineConfig
 from engines.llama_cpp import LlamaCppEngine
 from core.evaluator import is_json_schema_valid
-from core.utils import COMPILATION_TIMEOUT, GENERATION_TIMEOUT, safe_min
+from core.utils import COMPILATION_TIMEOUT, GENERATION_TIMEOUT, alarm_timeout, safe_min
 from core.types import (
     Schema,
     CompileStatus,
@@ -52,59 +52,53 @@ class GuidanceEngine(Engine[GuidanceConfig]):
         from guidance import json as guidance_json
 
         input = self.formatter(messages=output.messages)
-        output.token_usage.input_tokens = self.count_tokens(input)
+        input_tokens = self.count_tokens(input)
+        output.token_usage.input_tokens = input_tokens
 
         try:
-            with stopit.ThreadingTimeout(COMPILATION_TIMEOUT) as to_ctx_mgr:
-                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
+            try:
+                with alarm_timeout(COMPILATION_TIMEOUT):
                     generation_op = guidance_json(
                         schema=output.schema,
                         name="generated_object",
                         temperature=self.config.model_engine_config.temperature,
                         max_tokens=safe_min(
-                            self.config.model_engine_config.n_ctx
-                            - self.count_tokens(input),
+                            self.config.model_engine_config.n_ctx - input_tokens,
                             self.config.max_tokens,
                         ),
                         whitespace_flexible=self.config.whitespace_flexible,
                     )
-                    output.metadata.grammar_compilation_end_time = time()
-                    output.metadata.compile_status = CompileStatus(
-                        code=CompileStatusCode.OK
-                    )
-
-            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
+            except TimeoutError:
                 output.metadata.compile_status = CompileStatus(
                     code=CompileStatusCode.COMPILE_TIMEOUT,
                     message="Schema compilation timed out",
                 )
                 return
 
+            output.metadata.grammar_compilation_end_time = time()
+            output.metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
+
         except Exception as e:
             output.metadata.compile_status = CompileStatus(
                 code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(e)
             )
             return
 
+        deadline = time() + GENERATION_TIMEOUT
         try:
-            with stopit.ThreadingTimeout(GENERATION_TIMEOUT) as to_ctx_mgr:
-                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
-                    state_iterator = (
-                        self.guidance_model_state.stream() + input + generation_op
+            state_iterator = self.guidance_model_state.stream() + input + generation_op
+            for i, guidance_state in enumerate(state_iterator):
+                if i == 0:
+                    output.metadata.first_token_arrival_time = time()
+                elif time() > deadline:
+                    output.metadata.decoding_status = DecodingStatus(
+                        code=DecodingStatusCode.DECODING_TIMEOUT,
+                        message="Generation timed out",
                     )
-                    for i, guidance_state in enumerate(state_iterator):
-                        if i == 0:
-                            output.metadata.first_token_arrival_time = time()
-
-            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
-                output.metadata.decoding_status = DecodingStatus(
-                    code=DecodingStatusCode.DECODING_TIMEOUT,
-                    message="Generation timed out",
-                )
 
-                # unset the first token arrival time avoid false performance metrics
-                output.metadata.first_token_arrival_time = None
-                return
+                    # unset the first token arrival time avoid false performance metrics
+                    output.metadata.first_token_arrival_time = None
+                    return
 
         except Exception as e:
             output.metadata.decoding_status = DecodingStatus(
@@ -136,12 +130,11 @@ class GuidanceEngine(Engine[GuidanceConfig]):
     def adapt_schema(self, schema: Schema) -> Schema:
         if "type" not in schema:
             schema["type"] = "object"
-
-        if not is_json_schema_valid(schema):
-            print("The JSON schema after adaptation is no longer valid.")
+            if not is_json_schema_valid(schema):
+                print("The JSON schema after adaptation is no longer valid.")
         return schema
 
-    @property
+    @cached_property
     def max_context_length(self) -> int:
         return self.model.n_ctx()
 
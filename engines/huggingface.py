@@ -1,9 +1,9 @@
-import torch
-import stopit
-from time import time
-from typing import List, Optional
-from dataclasses import dataclass
-from transformers.generation import LogitsProcessor
+import re
+import queue
+import threading
+from time import time, perf_counter, perf_counter_ns
+from typing import List, Optional, TYPE_CHECKING
+from dataclasses import dataclass, field
 
 from core.utils import GENERATION_TIMEOUT
 from core.registry import register_engine
@@ -16,17 +16,70 @@ from core.types import (
     DecodingStatusCode,
 )
 
+# torch and transformers are imported when the engine is used, so importing
+# the engines package stays fast for API-based engines
+if TYPE_CHECKING:
+    import torch
+
+
+class FirstTokenTimer:
+    """Stopping criteria (duck-typed, to avoid importing transformers) that
+    never stops the generation and records when the first token was
+    produced. On CUDA the time comes from an event recorded on the stream,
+    so it reflects when the kernels finished rather than when they were
+    launched. The time is anchored to the wall clock, like the generation
+    start in profile.py."""
+
+    def __init__(self, device: str):
+        import torch
+
+        self.start_time = time()
+        self.start_ns = perf_counter_ns()
+        self.first_ns: Optional[int] = None
+        self.not_done: Optional["torch.Tensor"] = None
+        self.start_event = self.first_event = None
+        if device == "cuda":
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.start_event.record()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.not_done is None:
+            import torch
+
+            if self.start_event is not None:
+                self.first_event = torch.cuda.Event(enable_timing=True)
+                self.first_event.record()
+            else:
+                self.first_ns = perf_counter_ns()
+            self.not_done = torch.zeros(
+                input_ids.shape[0], dtype=torch.bool, device=input_ids.device
+            )
+        return self.not_done
+
+    @property
+    def first_token_arrival_time(self) -> Optional[float]:
+        if self.first_event is not None:
+            self.first_event.synchronize()
+            elapsed_ms = self.start_event.elapsed_time(self.first_event)
+            return self.start_time + elapsed_ms / 1000
+        if self.first_ns is not None:
+            return self.start_time + (self.first_ns - self.start_ns) / 1e9
+        return None
+
 
-class TimingLogitsProcessor(LogitsProcessor):
-    """Logits processor that records timestamps for token generation."""
+@dataclass
+class BatchResult:
+    status: DecodingStatus
+    first_token_arrival_time: Optional[float] = None
+    texts: Optional[List[str]] = None
 
-    def __init__(self):
-        super().__init__()
-        self.timestamps = []
 
-    def __call__(self, _, scores):
-        self.timestamps.append(time())
-        return scores
+@dataclass
+class BatchRequest:
+    input: str
+    done: threading.Event = field(default_factory=threading.Event)
+    index: int = 0
+    result: Optional[BatchResult] = None
 
 
 @dataclass
@@ -34,6 +87,14 @@ class HuggingFaceConfig(EngineConfig):
     model: str
     temperature: float = 0
     max_tokens: Optional[int] = 4096
+    static_cache: bool = False
+    # weight-only quantization: "int8" (bitsandbytes) or "fp8" (torchao)
+    quantization: Optional[str] = None
+    # generate concurrent requests together, see HuggingFaceEngine._run_batches;
+    # the reported times of a batched request include its wait for the batch
+    # to form and for the previous batch to finish, like a served request's
+    max_batch_size: int = 1
+    max_batch_wait_ms: float = 5
 
 
 class HuggingFaceEngine(Engine[HuggingFaceConfig]):
@@ -46,30 +107,91 @@ class HuggingFaceEngine(Engine[HuggingFaceConfig]):
         from transformers import AutoModelForCausalLM, AutoTokenizer
 
         self.tokenizer = AutoTokenizer.from_pretrained(self.config.model)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.config.model, torch_dtype=torch.bfloat16
-        ).to(self.device)
+        self.model = load_model(
+            AutoModelForCausalLM, self.config.model, self.device, self.config.quantization
+        )
         self.tokenizer.pad_token = self.tokenizer.eos_token
 
-    def _generate(self, output: GenerationOutput) -> None:
-        from transformers.generation import GenerationConfig
+        # requests are batched by a background thread, so callers may overlap;
+        # the thread pads with its own tokenizer, as a fast tokenizer can't be
+        # reconfigured while other threads encode with it
+        self._batch_queue: Optional["queue.Queue[BatchRequest]"] = None
+        self._batch_tokenizer = self.tokenizer
+        if self.config.max_batch_size > 1:
+            self.thread_safe = True
+            self._batch_tokenizer = AutoTokenizer.from_pretrained(self.config.model)
+            self._batch_tokenizer.pad_token = self._batch_tokenizer.eos_token
+            self._batch_tokenizer.padding_side = "left"
+            self._batch_queue = queue.Queue()
+            threading.Thread(target=self._run_batches, daemon=True).start()
+
+        if self.config.static_cache:
+            import torch
+
+            # with a fixed-size kv cache the decoding steps keep the same
+            # shapes, so the compiled forward can replay captured graphs
+            self.model.forward = torch.compile(
+                self.model.forward, mode="reduce-overhead", fullgraph=True
+            )
+            self._warmup()
+
+    def _warmup(self) -> None:
+        """Runs a couple of short generations so that compilation is not
+        counted in the first sample's timings."""
+        model_input = self.tokenizer(
+            "Hello", return_tensors="pt", add_special_tokens=False
+        ).to(self.device)
+        for _ in range(2):
+            self.model.generate(
+                **model_input, max_new_tokens=4, cache_implementation="static"
+            )
 
+    def _generate(self, output: GenerationOutput) -> None:
         # strictly speaking, HuggingFace does not have a grammar compilation step
         output.metadata.grammar_compilation_end_time = time()
         output.metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
 
-        timing_processor = TimingLogitsProcessor()
+        input = self.tokenizer.apply_chat_template(
+            output.messages, tokenize=False, add_generation_prompt=True
+        )
+
+        if self._batch_queue is None:
+            result = self._generate_batch([input])
+            output_text = result.texts[0] if result.texts else None
+        else:
+            request = BatchRequest(input)
+            self._batch_queue.put(request)
+            request.done.wait()
+            result = request.result
+            output_text = result.texts[request.index] if result.texts else None
+
+        output.metadata.decoding_status = result.status
+        if result.first_token_arrival_time is not None:
+            output.metadata.first_token_arrival_time = result.first_token_arrival_time
+        if output_text is None:
+            return
+
+        output.generation = extract_json_text_from_text(output_text)
+        output.token_usage.output_tokens = self.count_tokens(output_text)
+
+        return
+
+    def _generate_batch(self, inputs: List[str]) -> "BatchResult":
+        """Generates completions for several prompts in one `generate` call.
+        Prompts are left-padded, so all the generated tokens start at the
+        same position."""
+        from transformers.generation import GenerationConfig
+
+        first_token_timer = FirstTokenTimer(self.device)
         generation_config = GenerationConfig(
             temperature=self.config.temperature,
             max_new_tokens=self.config.max_tokens,
+            cache_implementation="static" if self.config.static_cache else None,
+            max_time=GENERATION_TIMEOUT,
         )
 
-        input = self.tokenizer.apply_chat_template(
-            output.messages, tokenize=False, add_generation_prompt=True
-        )
-
-        model_input = self.tokenizer(
-            input,
+        model_input = self._batch_tokenizer(
+            inputs,
             return_tensors="pt",
             add_special_tokens=False,
             padding=True,
@@ -79,51 +201,62 @@ class HuggingFaceEngine(Engine[HuggingFaceConfig]):
         input_length = model_input["input_ids"].shape[1]
 
         try:
-            with stopit.ThreadingTimeout(GENERATION_TIMEOUT) as to_ctx_mgr:
-                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
-                    model_output = self.model.generate(
-                        model_input["input_ids"],
-                        generation_config=generation_config,
-                        attention_mask=model_input["attention_mask"],
-                        max_new_tokens=self.config.max_tokens,
-                        logits_processor=[timing_processor],
-                    )
-                    output.metadata.decoding_status = DecodingStatus(
-                        code=DecodingStatusCode.OK
-                    )
-
-            if len(timing_processor.timestamps) > 0:
-                output.metadata.first_token_arrival_time = timing_processor.timestamps[
-                    0
-                ]
-
-            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
-                output.metadata.decoding_status = DecodingStatus(
-                    code=DecodingStatusCode.DECODING_TIMEOUT,
-                    message="Generation timed out",
+            # generate stops by itself once max_time has elapsed
+            start = perf_counter()
+            model_output = self.model.generate(
+                model_input["input_ids"],
+                generation_config=generation_config,
+                attention_mask=model_input["attention_mask"],
+                max_new_tokens=self.config.max_tokens,
+                stopping_criteria=[first_token_timer],
+            )
+
+            if perf_counter() - start >= GENERATION_TIMEOUT:
+                return BatchResult(
+                    status=DecodingStatus(
+                        code=DecodingStatusCode.DECODING_TIMEOUT,
+                        message="Generation timed out",
+                    ),
+                    first_token_arrival_time=first_token_timer.first_token_arrival_time,
                 )
-                return
 
         except Exception as e:
-            output.metadata.decoding_status = DecodingStatus(
-                code=DecodingStatusCode.UNKOWN_ERROR, message=str(e)
+            return BatchResult(
+                status=DecodingStatus(
+                    code=DecodingStatusCode.UNKOWN_ERROR, message=str(e)
+                )
             )
-            return
 
         generated_sequences = model_output[:, input_length:]
-        generated_texts = self.tokenizer.batch_decode(
-            generated_sequences, skip_special_tokens=True
+        return BatchResult(
+            status=DecodingStatus(code=DecodingStatusCode.OK),
+            first_token_arrival_time=first_token_timer.first_token_arrival_time,
+            texts=self._batch_tokenizer.batch_decode(
+                generated_sequences, skip_special_tokens=True
+            ),
         )
 
-        output_text = generated_texts[0] if generated_texts else ""
-
-        if timing_processor.timestamps:
-            output.metadata.first_token_arrival_time = timing_processor.timestamps[0]
-
-        output.generation = extract_json_text_from_text(output_text)
-        output.token_usage.output_tokens = self.count_tokens(output_text)
-
-        return
+    def _run_batches(self) -> None:
+        """Collects concurrent requests into batches of up to `max_batch_size`
+        prompts, waiting at most `max_batch_wait_ms` for a batch to fill."""
+        max_wait = self.config.max_batch_wait_ms / 1000
+        while True:
+            requests = [self._batch_queue.get()]
+            deadline = perf_counter() + max_wait
+            while len(requests) < self.config.max_batch_size:
+                timeout = deadline - perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self._batch_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            result = self._generate_batch([request.input for request in requests])
+            for index, request in enumerate(requests):
+                request.index = index
+                request.result = result
+                request.done.set()
 
     def encode(self, text: str) -> List[int]:
         return self.tokenizer.encode(text, add_special_tokens=False)
@@ -137,6 +270,8 @@ class HuggingFaceEngine(Engine[HuggingFaceConfig]):
 
 
 def get_best_device():
+    import torch
+
     if torch.cuda.is_available():
         return "cuda"
     elif torch.backends.mps.is_available():
@@ -145,11 +280,45 @@ def get_best_device():
         return "cpu"
 
 
+def load_model(model_class, model: str, device: str, quantization: Optional[str]):
+    import torch
+
+    if quantization is None:
+        return model_class.from_pretrained(model, torch_dtype=torch.bfloat16).to(
+            device
+        )
+
+    if quantization == "int8":
+        from transformers import BitsAndBytesConfig
+
+        # bitsandbytes places the weights itself and they cannot be moved after
+        return model_class.from_pretrained(
+            model,
+            torch_dtype=torch.bfloat16,
+            quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+            device_map=device,
+        )
+
+    if quantization == "fp8":
+        from torchao.quantization import quantize_, Float8WeightOnlyConfig
+
+        loaded = model_class.from_pretrained(model, torch_dtype=torch.bfloat16).to(
+            device
+        )
+        quantize_(loaded, Float8WeightOnlyConfig())
+        return loaded
+
+    raise ValueError(f"Unknown quantization: {quantization}")
+
+
+# the first ```json block, up to its closing fence or the end of the text; a
+# fence that runs into a following ```json ends the block at that ```json
+_JSON_BLOCK = re.compile(r"```json(.*?)(?:```(?!`{1,2}json)|\Z)", re.DOTALL)
+
+
 def extract_json_text_from_text(text: str) -> str:
-    if "```json" in text:
-        return text.split("```json")[1].split("```")[0].strip()
-    else:
-        return text.strip()
+    match = _JSON_BLOCK.search(text)
+    return match.group(1).strip() if match else text.strip()
 
 
 register_engine(HuggingFaceEngine, HuggingFaceConfig)
@@ -1,27 +1,34 @@
 import os
 import time
-import stopit
-from json import dumps
+from orjson import dumps
+from multiprocessing import Pipe, get_context
+from functools import cached_property
 from dataclasses import dataclass
 from typing import List, Dict, Any, Optional, TYPE_CHECKING
 
 from core.registry import register_engine
 from core.engine import Engine, EngineConfig
-from core.utils import COMPILATION_TIMEOUT, GENERATION_TIMEOUT
+from core.utils import COMPILATION_TIMEOUT, GENERATION_TIMEOUT, alarm_timeout
 from core.types import (
-    Token,
+    Schema,
     CompileStatus,
     DecodingStatus,
     GenerationOutput,
     CompileStatusCode,
     DecodingStatusCode,
+    GenerationMetadata,
 )
 
 if TYPE_CHECKING:
     from llama_cpp import Llama
+    from multiprocessing.connection import Connection
+    from multiprocessing.process import BaseProcess
+    from llama_cpp._internals import LlamaModel
     from llama_cpp.llama_grammar import LlamaGrammar
     from llama_cpp.llama_chat_format import ChatFormatter
 
+GRAMMAR_SAFETY_TIMEOUT = 15
+
 
 class LlamaCppChatFormatter:
     def __init__(self, formatter: "ChatFormatter"):
@@ -40,6 +47,7 @@ class LlamaCppConfig(EngineConfig):
     n_gpu_layers: int = -1
     temperature: float = 0.2
     llama_cpp_max_tokens: Optional[int] = None
+    grammar_cache_enabled: bool = False
 
 
 class LlamaCppEngine(Engine[LlamaCppConfig]):
@@ -59,81 +67,59 @@ class LlamaCppEngine(Engine[LlamaCppConfig]):
         )
 
         self.formatter = self.get_chat_formatter(self.model)
+        self._safety_worker: Optional["BaseProcess"] = None
+        self._start_safety_worker()
 
     def _generate(self, output: GenerationOutput) -> None:
-        from llama_cpp.llama_grammar import LlamaGrammar
-
         input = self.formatter(messages=output.messages)
         output.token_usage.input_tokens = self.count_tokens(input)
 
-        grammar = None
-        try:
-            with stopit.ThreadingTimeout(COMPILATION_TIMEOUT) as to_ctx_mgr:
-                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
-                    grammar = LlamaGrammar.from_json_schema(
-                        dumps(output.schema), verbose=False
-                    )
-                    output.metadata.grammar_compilation_end_time = time.time()
-                    output.metadata.compile_status = CompileStatus(
-                        code=CompileStatusCode.OK
-                    )
-
-            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
-                output.metadata.compile_status = CompileStatus(
-                    code=CompileStatusCode.COMPILE_TIMEOUT,
-                    message="Grammar compilation timed out",
-                )
-                return
-
-            segfault_check = self._check_grammar_safety(grammar)
-            if not segfault_check["success"]:
-                output.metadata.compile_status = CompileStatus(
-                    code=CompileStatusCode.UNSUPPORTED_SCHEMA,
-                    message=f"Failed to add grammar to sampler: {segfault_check}",
-                )
-                return
-
-        except Exception as e:
-            output.metadata.compile_status = CompileStatus(
-                code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(e)
-            )
+        grammar = self._compile_grammar(output.schema, output.metadata)
+        if grammar is None:
             return
 
+        deadline = time.time() + GENERATION_TIMEOUT
         try:
-            with stopit.ThreadingTimeout(GENERATION_TIMEOUT) as to_ctx_mgr:
-                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
-                    generator = self.model.create_chat_completion(
-                        messages=output.messages,
-                        stream=True,
-                        grammar=grammar,
-                        temperature=self.config.temperature,
-                        max_tokens=self.config.llama_cpp_max_tokens,
-                    )
-
-                    tokens_str = []
-                    for i, chunk in enumerate(generator):
-                        if i == 0:
-                            output.metadata.first_token_arrival_time = time.time()
-
-                        if (
-                            len(chunk["choices"]) == 0
-                            or chunk["choices"][0]["finish_reason"] is not None
-                        ):
-                            continue
-
-                        chunk_content = chunk["choices"][0]["delta"].get("content", "")
-                        if chunk_content:
-                            tokens_str.append(chunk_content)
-
-                    output.metadata.decoding_status = DecodingStatus(
-                        code=DecodingStatusCode.OK
-                    )
+            generator = self.model.create_chat_completion(
+                messages=output.messages,
+                stream=True,
+                grammar=grammar,
+                temperature=self.config.temperature,
+                max_tokens=self.config.llama_cpp_max_tokens,
+            )
 
-            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
+            timed_out = False
+            tokens_str = []
+            append = tokens_str.append
+            now = time.time
+            for i, chunk in enumerate(generator):
+                if i == 0:
+                    output.metadata.first_token_arrival_time = now()
+                elif now() > deadline:
+                    timed_out = True
+                    generator.close()
+                    break
+
+                choices = chunk["choices"]
+                if not choices:
+                    continue
+                choice = choices[0]
+                if choice["finish_reason"] is not None:
+                    continue
+
+                chunk_content = choice["delta"].get("content")
+                if chunk_content:
+                    append(chunk_content)
+
+            if timed_out:
                 output.metadata.decoding_status = DecodingStatus(
                     code=DecodingStatusCode.DECODING_TIMEOUT,
                     message="Generation timed out",
                 )
+            else:
+                output.metadata.decoding_status = DecodingStatus(
+                    code=DecodingStatusCode.OK
+                )
 
         except Exception as e:
             output.metadata.decoding_status = DecodingStatus(
@@ -144,51 +130,137 @@ class LlamaCppEngine(Engine[LlamaCppConfig]):
 
         generation = "".join(tokens_str)
 
+        # encoded once for both the token count, which includes the BOS token
+        # like count_tokens, and the ids of the streamed tokens
+        ids = self.encode(generation)
         output.generation = generation
-        output.token_usage.output_tokens = self.count_tokens(generation)
-        output.generated_tokens = [
-            Token(id=self.convert_token_to_id(token), text=token)
-            for token in tokens_str
-        ]
+        output.token_usage.output_tokens = len(ids)
+        output.generated_tokens = self.tokens_from_chunks(
+            tokens_str, ids[1:] if ids and ids[0] == self.model.token_bos() else ids
+        )
 
         return
 
-    def _check_grammar_safety(self, grammar: "LlamaGrammar") -> Dict[str, Any]:
-        def child_process():
-            import signal
-            from llama_cpp._internals import LlamaSampler
+    def _compile_grammar(
+        self, schema: Schema, metadata: GenerationMetadata
+    ) -> Optional["LlamaGrammar"]:
+        from llama_cpp.llama_grammar import LlamaGrammar
 
-            signal.signal(signal.SIGALRM, lambda _, __: os._exit(2))
-            signal.alarm(15)
+        # grammars are only cached once they passed the safety check
+        if self.config.grammar_cache_enabled:
+            key = self.schema_fingerprint(schema)
+            grammar = self._compiled_schemas.get(key)
+            if grammar is not None:
+                metadata.grammar_compilation_end_time = time.time()
+                metadata.grammar_cached = True
+                metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
+                return grammar
+
+        try:
             try:
-                LlamaSampler().add_grammar(self.model._model, grammar)
-                os._exit(0)
-            except Exception:
-                os._exit(1)
-
-        id = os.fork()
-        if id == 0:
-            child_process()
-        else:
-            _, status = os.waitpid(id, 0)
-            if os.WIFEXITED(status):
-                exit_code = os.WEXITSTATUS(status)
+                with alarm_timeout(COMPILATION_TIMEOUT):
+                    grammar = LlamaGrammar.from_json_schema(
+                        dumps(schema).decode(), verbose=False
+                    )
+            except TimeoutError:
+                metadata.compile_status = CompileStatus(
+                    code=CompileStatusCode.COMPILE_TIMEOUT,
+                    message="Grammar compilation timed out",
+                )
+                return None
+
+            metadata.grammar_compilation_end_time = time.time()
+            metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
+
+            segfault_check = self._check_grammar_safety(grammar)
+            if not segfault_check["success"]:
+                metadata.compile_status = CompileStatus(
+                    code=CompileStatusCode.UNSUPPORTED_SCHEMA,
+                    message=f"Failed to add grammar to sampler: {segfault_check}",
+                )
+                return None
+
+        except Exception as e:
+            metadata.compile_status = CompileStatus(
+                code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(e)
+            )
+            return None
+
+        if self.config.grammar_cache_enabled:
+            self._compiled_schemas[key] = grammar
+
+        return grammar
+
+    def _check_grammar_safety(self, grammar: "LlamaGrammar") -> Dict[str, Any]:
+        if self._safety_worker is None or not self._safety_worker.is_alive():
+            self._start_safety_worker()
+
+        self._safety_conn.send(grammar._grammar)
+        try:
+            if self._safety_conn.poll(GRAMMAR_SAFETY_TIMEOUT + 5):
+                exit_code = self._safety_conn.recv()
                 return {"success": exit_code == 0, "exit_code": exit_code}
-            return {"success": False, "error": "Unknown status"}
+        except EOFError:
+            pass
+
+        # the worker crashed or hung while adding the grammar; it is replaced
+        # right away rather than when the next sample checks its grammar
+        self._stop_safety_worker()
+        exit_code = self._safety_worker.exitcode
+        self._start_safety_worker()
+        if exit_code is not None and exit_code >= 0:
+            return {"success": False, "exit_code": exit_code}
+        return {"success": False, "error": "Unknown status"}
+
+    def _start_safety_worker(self) -> None:
+        # forked so that the worker shares the already loaded model
+        self._safety_conn, child_conn = Pipe()
+        self._safety_worker = get_context("fork").Process(
+            target=_grammar_safety_worker,
+            args=(child_conn, self.model._model),
+            daemon=True,
+        )
+        self._safety_worker.start()
+        child_conn.close()
+
+    def _stop_safety_worker(self) -> None:
+        if self._safety_worker is None:
+            return
+        if self._safety_worker.is_alive():
+            try:
+                self._safety_conn.send(None)
+            except OSError:
+                pass
+            self._safety_worker.join(1)
+            if self._safety_worker.is_alive():
+                self._safety_worker.kill()
+        self._safety_worker.join()
+        self._safety_conn.close()
 
     def encode(self, text: str) -> List[int]:
         byte_string = text.encode("utf-8")
         return self.model.tokenize(byte_string)
 
+    def convert_token_to_id(self, token: str) -> Optional[int]:
+        # without the BOS token that encode prepends
+        try:
+            return self._token_ids[token]
+        except KeyError:
+            pass
+        res = self.model.tokenize(token.encode("utf-8"), add_bos=False)
+        id = self._token_ids[token] = res[0] if res else None
+        return id
+
     def decode(self, ids: List[int]) -> str:
         byte_string = self.model.detokenize(ids)
         return byte_string.decode("utf-8")
 
-    @property
+    @cached_property
     def max_context_length(self) -> int:
         return self.model.n_ctx()
 
     def close(self):
+        self._stop_safety_worker()
         self.model._sampler.close()
         self.model.close()
 
@@ -214,4 +286,31 @@ class LlamaCppEngine(Engine[LlamaCppConfig]):
             raise ValueError("No chat template found in model metadata")
 
 
+def _grammar_safety_worker(conn: "Connection", model: "LlamaModel") -> None:
+    """Adds each received grammar to a fresh sampler and replies with 0 on
+    success or 1 on error. A grammar that crashes llama.cpp takes the worker
+    down with it, and one that hangs makes it exit with code 2."""
+    import signal
+    from llama_cpp.llama_grammar import LlamaGrammar
+    from llama_cpp._internals import LlamaSampler
+
+    signal.signal(signal.SIGALRM, lambda _, __: os._exit(2))
+    while True:
+        grammar_str = conn.recv()
+        if grammar_str is None:
+            break
+
+        signal.alarm(GRAMMAR_SAFETY_TIMEOUT)
+        try:
+            grammar = LlamaGrammar.from_string(grammar_str, verbose=False)
+            sampler = LlamaSampler()
+            sampler.add_grammar(model, grammar)
+            del sampler
+            exit_code = 0
+        except Exception:
+            exit_code = 1
+        signal.alarm(0)
+        conn.send(exit_code)
+
+
 register_engine(LlamaCppEngine, LlamaCppConfig)
@@ -1,13 +1,15 @@
 import os
-from time import time
+from time import sleep, time
+from orjson import dumps, loads
 from dataclasses import dataclass
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 
 from core.registry import register_engine
 from core.engine import Engine, EngineConfig
+from core.messages import Message
 from core.evaluator import is_json_schema_valid
 from core.types import (
-    Token,
+    Schema,
     CompileStatus,
     DecodingStatus,
     GenerationOutput,
@@ -15,6 +17,15 @@ from core.types import (
     DecodingStatusCode,
 )
 
+MAX_CONTEXT_LENGTHS = {
+    "gpt-4o": 128 * 1000,
+    "gpt-4o-mini": 128 * 1000,
+}
+
+# seconds between two status checks of a submitted batch
+BATCH_POLL_INTERVAL = 30
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
 
 @dataclass
 class OpenAIConfig(EngineConfig):
@@ -25,6 +36,7 @@ class OpenAIConfig(EngineConfig):
 
 class OpenAIEngine(Engine[OpenAIConfig]):
     name = "openai"
+    thread_safe = True
 
     def __init__(
         self,
@@ -45,15 +57,18 @@ class OpenAIEngine(Engine[OpenAIConfig]):
             encoding_for_model(self.config.model) if base_url is None else None
         )
 
+    def _response_format(self, schema: Schema) -> Dict[str, Any]:
+        return {
+            "type": "json_schema",
+            "json_schema": {"schema": schema, "name": "json_schema"},
+        }
+
     def _generate(self, output: GenerationOutput) -> None:
         try:
             response = self.client.chat.completions.create(
                 model=self.config.model,
                 messages=output.messages,
-                response_format={
-                    "type": "json_schema",
-                    "json_schema": {"schema": output.schema, "name": "json_schema"},
-                },
+                response_format=self._response_format(output.schema),
                 stream=True,
                 temperature=self.config.temperature,
                 max_tokens=self.config.max_tokens,
@@ -66,18 +81,18 @@ class OpenAIEngine(Engine[OpenAIConfig]):
             return
 
         tokens_str: List[str] = []
+        append = tokens_str.append
         for i, chunk in enumerate(response):
             if i == 0:
                 first_token_arrival_time = time()
 
-            if len(chunk.choices) == 0 or chunk.choices[0].finish_reason is not None:
+            choices = chunk.choices
+            if not choices or choices[0].finish_reason is not None:
                 continue
 
-            chunk_content = chunk.choices[0].delta.content
-            if chunk_content == "":
-                continue
-
-            tokens_str.append(chunk_content)
+            chunk_content = choices[0].delta.content
+            if chunk_content:
+                append(chunk_content)
 
         output.token_usage.output_tokens = chunk.usage.completion_tokens
         output.metadata.first_token_arrival_time = first_token_arrival_time
@@ -85,17 +100,117 @@ class OpenAIEngine(Engine[OpenAIConfig]):
         output.metadata.decoding_status = DecodingStatus(code=DecodingStatusCode.OK)
 
         output.generation = "".join(tokens_str)
-        output.generated_tokens = [
-            Token(id=self.convert_token_to_id(token), text=token)
-            for token in tokens_str
-        ]
+        output.generated_tokens = self.tokens_from_chunks(
+            tokens_str, self.encode(output.generation)
+        )
         return
 
+    def generate_batch(
+        self, task: str, samples: List[Tuple[List[Message], Schema]]
+    ) -> List[GenerationOutput]:
+        """Generates the outputs of all the samples of a task with a single
+        job of the Batch API, which is billed at half the price and is not
+        subject to the per-minute rate limits. Batches can take hours to
+        complete and report no per-token timing, so the outputs have no
+        performance metrics.
+
+        :param task: str
+            The task to generate the JSON objects for.
+        :param samples: List[Tuple[List[Message], Schema]]
+            The messages and schema of each sample.
+        :return: List[GenerationOutput]
+            The generation outputs, in the order of the samples.
+        """
+        outputs = []
+        lines = []
+        for i, (messages, schema) in enumerate(samples):
+            schema = self._adapt_schema_cached(schema)
+            outputs.append(
+                GenerationOutput(
+                    task=task, messages=messages, generation="", schema=schema
+                )
+            )
+            body = {
+                "model": self.config.model,
+                "messages": messages,
+                "response_format": self._response_format(schema),
+            }
+            if self.config.temperature is not None:
+                body["temperature"] = self.config.temperature
+            if self.config.max_tokens is not None:
+                body["max_tokens"] = self.config.max_tokens
+            lines.append(
+                dumps(
+                    {
+                        "custom_id": str(i),
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": body,
+                    }
+                )
+            )
+
+        input_file = self.client.files.create(
+            file=(f"{task}.jsonl", b"\n".join(lines)), purpose="batch"
+        )
+        try:
+            batch = self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            )
+            print(f"Submitted batch {batch.id} with {len(lines)} requests")
+            while batch.status not in BATCH_FINAL_STATUSES:
+                sleep(BATCH_POLL_INTERVAL)
+                batch = self.client.batches.retrieve(batch.id)
+        finally:
+            self.client.files.delete(input_file.id)
+        print(f"Batch {batch.id} {batch.status}")
+
+        # successful requests are in the output file and rejected ones in the
+        # error file; requests left unprocessed by a failed or expired batch
+        # are in neither
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is None:
+                continue
+            for line in self.client.files.content(file_id).content.splitlines():
+                result = loads(line)
+                self._set_batch_result(outputs[int(result["custom_id"])], result)
+
+        for output in outputs:
+            if output.metadata.compile_status.code == CompileStatusCode.TBD:
+                output.metadata.compile_status = CompileStatus(
+                    code=CompileStatusCode.API_BAD_RESPONSE,
+                    message=f"No result in batch {batch.id} ({batch.status})",
+                )
+            with self._usage_lock:
+                self.total_usage += output.token_usage
+        return outputs
+
+    def _set_batch_result(
+        self, output: GenerationOutput, result: Dict[str, Any]
+    ) -> None:
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            error = result.get("error") or response.get("body", {}).get("error")
+            output.metadata.compile_status = CompileStatus(
+                code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(error)
+            )
+            return
+
+        completion = response["body"]
+        output.generation = completion["choices"][0]["message"]["content"] or ""
+        output.token_usage.output_tokens = completion["usage"]["completion_tokens"]
+        output.metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
+        output.metadata.decoding_status = DecodingStatus(code=DecodingStatusCode.OK)
+        if self.tokenizer is not None:
+            ids = self.encode(output.generation)
+            output.generated_tokens = self.tokens_from_chunks(
+                [self.decode([id]) for id in ids], ids
+            )
+
     def adapt_schema(self, schema: Dict[str, Any]) -> Dict[str, Any]:
-        recursively_set_additional_properties_false(schema)
-        add_root_type_if_missing(schema)
-        schema = set_all_properties_required(schema)
-        if not is_json_schema_valid(schema):
+        if make_schema_strict(schema) and not is_json_schema_valid(schema):
             print("The JSON schema after adaptation is no longer valid.")
         return schema
 
@@ -107,44 +222,57 @@ class OpenAIEngine(Engine[OpenAIConfig]):
 
     @property
     def max_context_length(self):
-        max_context_length_dict = {
-            "gpt-4o": 128 * 1000,
-            "gpt-4o-mini": 128 * 1000,
-        }
-        return max_context_length_dict[self.config.model]
+        return MAX_CONTEXT_LENGTHS[self.config.model]
 
 
-def add_root_type_if_missing(schema: dict):
-    if "type" not in schema:
-        schema["type"] = "object"
+# how a node was reached: subschemas reached from the root through properties
+# and items get additionalProperties, the others only their required list
+_PLAIN, _SUBSCHEMA, _PROPERTIES = 0, 1, 2
 
 
-def recursively_set_additional_properties_false(schema: dict):
-    if not isinstance(schema, dict):
-        return
-    if (
-        "additionalProperties" not in schema or schema["additionalProperties"]
-    ) and schema.get("properties"):
+def _forbid_additional_properties(schema: dict) -> bool:
+    if schema.get("properties") and schema.get("additionalProperties", True):
         schema["additionalProperties"] = False
-    if "properties" in schema:
-        for prop in schema["properties"]:
-            recursively_set_additional_properties_false(schema["properties"][prop])
-    if "items" in schema:
-        recursively_set_additional_properties_false(schema["items"])
+        return True
+    return False
 
 
-def set_all_properties_required(schema: object) -> object:
-    if not isinstance(schema, dict):
-        return schema
-    if "properties" in schema:
-        schema["required"] = list(schema["properties"].keys())
-    for value in schema.values():
-        if isinstance(value, dict):
-            set_all_properties_required(value)
-        elif isinstance(value, list):
-            for item in value:
-                set_all_properties_required(item)
-    return schema
+def make_schema_strict(schema: dict) -> bool:
+    """Sets additionalProperties to false on the root and the subschemas
+    nested through properties and items, adds a missing root type and marks
+    every property as required, in a single walk over the schema.
+    Returns whether the schema was modified."""
+    changed = False
+    stack = [(schema, _SUBSCHEMA)]
+    while stack:
+        node, kind = stack.pop()
+        properties = node.get("properties")
+        if kind == _SUBSCHEMA:
+            changed |= _forbid_additional_properties(node)
+        elif kind == _PROPERTIES and isinstance(properties, dict):
+            # a property named "properties" is a subschema whose keys end up
+            # in this node's required list, so it is adapted first
+            changed |= _forbid_additional_properties(properties)
+        if node is schema and "type" not in node:
+            node["type"] = "object"
+            changed = True
+        if "properties" in node:
+            required = list(properties.keys())
+            if node.get("required") != required:
+                node["required"] = required
+                changed = True
+
+        for key, value in node.items():
+            if isinstance(value, dict):
+                if kind == _PROPERTIES or (kind == _SUBSCHEMA and key == "items"):
+                    stack.append((value, _SUBSCHEMA))
+                elif kind == _SUBSCHEMA and key == "properties":
+                    stack.append((value, _PROPERTIES))
+                else:
+                    stack.append((value, _PLAIN))
+            elif isinstance(value, list):
+                stack.extend((item, _PLAIN) for item in value if isinstance(item, dict))
+    return changed
 
 
 register_engine(OpenAIEngine, OpenAIConfig)
@@ -1,11 +1,16 @@
 import os
-from time import time
+import atexit
+from random import random
+from time import sleep, time
+from functools import lru_cache
 from dataclasses import dataclass
-from typing import Dict, Any, List, Optional
+from orjson import dumps, loads
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from core.registry import register_engine
 from core.engine import Engine, EngineConfig
 from core.evaluator import is_json_schema_valid
+from engines.openai import make_schema_strict
 from core.types import (
     Token,
     CompileStatus,
@@ -17,6 +22,11 @@ from core.types import (
 
 MAX_RETRIES=3
 TIMEOUT=30
+# rate limited and server failed requests sent without the OpenAI client are
+# retried like the client does: 0.5s doubling up to 8s, minus up to 25% jitter
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+INITIAL_RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 8.0
 
 @dataclass
 class OpenAICompatibleConfig(EngineConfig):
@@ -28,10 +38,25 @@ class OpenAICompatibleConfig(EngineConfig):
     max_tokens: Optional[int] = None
     temperature: Optional[float] = None
     max_context_length: Optional[int] = 4096
+    # stream responses with plain HTTP requests instead of the OpenAI client,
+    # which skips building a response object for every chunk
+    raw_http: bool = False
+    # whether streamed tokens are saved with their ids or only their text
+    collect_token_ids: bool = True
+    # HTTP/2 for the provider's connection pool, which needs the h2 package
+    http2: bool = False
+    # stream the responses; without streaming there is a single response, so
+    # the time to first token is the time to the whole generation
+    stream: bool = True
+    # requests in flight at once for the provider when benchmarked by
+    # multiple_providers_runner, so that each provider tier can stay within its
+    # rate limits; it is split between the provider's models running at once
+    max_concurrency: int = 8
 
 
 class OpenAICompatibleEngine(Engine[OpenAICompatibleConfig]):
     name = "openai_compatible"
+    thread_safe = True
 
     def __init__(
         self,
@@ -40,84 +65,160 @@ class OpenAICompatibleEngine(Engine[OpenAICompatibleConfig]):
         super().__init__(config)
 
         from openai import OpenAI
-        from transformers import AutoTokenizer
 
+        # engines of the same provider share one connection pool, so its
+        # connections stay alive across models
+        self.http_client = load_http_client(self.config.base_url, self.config.http2)
         self.client = OpenAI(
             api_key=os.getenv(self.config.api_key_variable_name),
             base_url=self.config.base_url,
             timeout=TIMEOUT,
-            max_retries=MAX_RETRIES
+            max_retries=MAX_RETRIES,
+            http_client=self.http_client,
         )
          
-        self.tokenizer = AutoTokenizer.from_pretrained(self.config.tokenizer)
+        self.tokenizer = load_tokenizer(self.config.tokenizer)
 
 
+    def check_health(self, timeout: float) -> None:
+        """Sends a one-token request, raising if the provider rejects it."""
+        self.client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+            model=self.config.model,
+            messages=[{"role": "user", "content": "ping"}],
+            max_tokens=1,
+        )
+
     def _generate(self, output: GenerationOutput) -> None:
         try:
-            response = self.client.chat.completions.create(
-                model=self.config.model,
-                messages=output.messages,
-                response_format={
-                    "type": "json_schema",
-                    "json_schema": {"schema": output.schema, "name": "json_schema"},
-                },
-                stream=True,
-                temperature=self.config.temperature,
-                max_tokens=self.config.max_tokens,
-                stream_options={"include_usage": True},
-            )
+            if self.config.raw_http:
+                stream = self._send_raw_request(output)
+            else:
+                response = self.client.chat.completions.create(
+                    model=self.config.model,
+                    messages=output.messages,
+                    response_format={
+                        "type": "json_schema",
+                        "json_schema": {
+                            "schema": output.schema,
+                            "name": "json_schema",
+                        },
+                    },
+                    temperature=self.config.temperature,
+                    max_tokens=self.config.max_tokens,
+                    **(
+                        {"stream": True, "stream_options": {"include_usage": True}}
+                        if self.config.stream
+                        else {}
+                    ),
+                )
+                if self.config.stream:
+                    stream = iter_sdk_chunks(response)
+                else:
+                    stream = iter_sdk_response(response)
         except Exception as e:
             output.metadata.compile_status = CompileStatus(
                 code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(e)
             )
             return
 
-        chunk = None
+        received = False
+        completion_tokens = None
         first_token_arrival_time = None
         tokens_str: List[str] = []
         try:
-            for i, chunk in enumerate(response):
+            for i, (chunk_content, completion_tokens) in enumerate(stream):
                 if i == 0:
+                    received = True
                     first_token_arrival_time = time()
 
-                if len(chunk.choices) == 0 or (chunk.choices[0].finish_reason is not None and chunk.choices[0].finish_reason != "stop"):
-                    continue
-
-                chunk_content = chunk.choices[0].delta.content
-                if chunk_content == "" or chunk_content is None:
-                    continue
-
-                tokens_str.append(chunk_content)
+                if chunk_content:
+                    tokens_str.append(chunk_content)
         except Exception as e:
             output.metadata.compile_status = CompileStatus(
                 code=CompileStatusCode.API_BAD_RESPONSE, message=str(e)
             )
             return
 
-        if chunk is None:
+        if not received:
             output.metadata.compile_status = CompileStatus(
                 code=CompileStatusCode.API_BAD_RESPONSE, message="Empty stream response"
             )
             return
 
-        if chunk.usage is not None:
-            output.token_usage.output_tokens = chunk.usage.completion_tokens
+        # the usage is only reported by the last chunk
+        if completion_tokens is not None:
+            output.token_usage.output_tokens = completion_tokens
         output.metadata.first_token_arrival_time = first_token_arrival_time
         output.metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
         output.metadata.decoding_status = DecodingStatus(code=DecodingStatusCode.OK)
 
         output.generation = "".join(tokens_str)
-        output.generated_tokens = [
-            Token(id=self.convert_token_to_id(token), text=token)
-            for token in tokens_str
-        ]
+        if not self.config.stream and self.config.collect_token_ids:
+            # there are no chunks, so the tokens are recovered from the text
+            ids = self.tokenizer.encode(output.generation, add_special_tokens=False)
+            texts = self.tokenizer.batch_decode([[id] for id in ids])
+            output.generated_tokens = [
+                Token(id=id, text=text) for id, text in zip(ids, texts)
+            ]
+        elif self.config.collect_token_ids and tokens_str:
+            # all the chunks are tokenized in a single batched call
+            chunk_ids = self.tokenizer(tokens_str, add_special_tokens=False)["input_ids"]
+            output.generated_tokens = [
+                Token(id=ids[0] if ids else None, text=token)
+                for ids, token in zip(chunk_ids, tokens_str)
+            ]
+        else:
+            output.generated_tokens = [Token(text=token) for token in tokens_str]
         return
 
+    def _send_raw_request(
+        self, output: GenerationOutput
+    ) -> Iterator[Tuple[Optional[str], Optional[int]]]:
+        """Sends the chat completion request directly, without the OpenAI
+        client, and returns its chunks once the server accepted it."""
+        payload = {
+            "model": self.config.model,
+            "messages": output.messages,
+            "response_format": {
+                "type": "json_schema",
+                "json_schema": {"schema": output.schema, "name": "json_schema"},
+            },
+            "stream": self.config.stream,
+        }
+        if self.config.stream:
+            payload["stream_options"] = {"include_usage": True}
+        if self.config.temperature is not None:
+            payload["temperature"] = self.config.temperature
+        if self.config.max_tokens is not None:
+            payload["max_tokens"] = self.config.max_tokens
+
+        request = self.http_client.build_request(
+            "POST",
+            "chat/completions",
+            content=dumps(payload),
+            headers={
+                "Authorization": f"Bearer {os.getenv(self.config.api_key_variable_name)}",
+                "Content-Type": "application/json",
+            },
+        )
+        for attempt in range(MAX_RETRIES + 1):
+            response = self.http_client.send(request, stream=self.config.stream)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == MAX_RETRIES:
+                break
+            response.close()
+            sleep(retry_delay(attempt, response.headers.get("retry-after")))
+        if response.is_error:
+            response.read()
+            response.close()
+            raise RuntimeError(
+                f"Error code: {response.status_code} - {response.text}"
+            )
+        if not self.config.stream:
+            return iter_json_response(loads(response.content))
+        return iter_sse_chunks(response)
+
     def adapt_schema(self, schema: Dict[str, Any]) -> Dict[str, Any]:
-        recursively_set_additional_properties_false(schema)
-        add_root_type_if_missing(schema)
-        schema = set_all_properties_required(schema)
-        if not is_json_schema_valid(schema):
+        if make_schema_strict(schema) and not is_json_schema_valid(schema):
             print("The JSON schema after adaptation is no longer valid.")
         return schema
 
@@ -132,37 +233,114 @@ class OpenAICompatibleEngine(Engine[OpenAICompatibleConfig]):
         return self.config.max_context_length
 
 
-def add_root_type_if_missing(schema: dict):
-    if "type" not in schema:
-        schema["type"] = "object"
+def retry_delay(attempt: int, retry_after: Optional[str]) -> float:
+    """Returns the seconds to wait before retrying a request, which is the
+    server's Retry-After when it is a reasonable number of seconds."""
+    try:
+        seconds = float(retry_after) if retry_after is not None else None
+    except ValueError:
+        seconds = None
+    if seconds is not None and 0 < seconds <= 60:
+        return seconds
+    delay = min(INITIAL_RETRY_DELAY * 2**attempt, MAX_RETRY_DELAY)
+    return delay * (1 - 0.25 * random())
 
 
-def recursively_set_additional_properties_false(schema: dict):
-    if not isinstance(schema, dict):
-        return
-    if (
-        "additionalProperties" not in schema or schema["additionalProperties"]
-    ) and schema.get("properties"):
-        schema["additionalProperties"] = False
-    if "properties" in schema:
-        for prop in schema["properties"]:
-            recursively_set_additional_properties_false(schema["properties"][prop])
-    if "items" in schema:
-        recursively_set_additional_properties_false(schema["items"])
-
-
-def set_all_properties_required(schema: object) -> object:
-    if not isinstance(schema, dict):
-        return schema
-    if "properties" in schema:
-        schema["required"] = list(schema["properties"].keys())
-    for value in schema.values():
-        if isinstance(value, dict):
-            set_all_properties_required(value)
-        elif isinstance(value, list):
-            for item in value:
-                set_all_properties_required(item)
-    return schema
+@lru_cache(maxsize=None)
+def load_http_client(base_url: str, http2: bool = False):
+    """Creates one keep-alive HTTP client per base URL and process, closed
+    when the process exits."""
+    import httpx
+
+    # the pool limits are the OpenAI client's defaults
+    http_client = httpx.Client(
+        base_url=base_url.rstrip("/") + "/",
+        timeout=TIMEOUT,
+        follow_redirects=True,
+        transport=httpx.HTTPTransport(
+            retries=MAX_RETRIES,
+            http2=http2,
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+        ),
+    )
+    atexit.register(http_client.close)
+    return http_client
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer(name: str):
+    """Loads the fast tokenizer once per process, so that engines of models
+    that share a tokenizer also share its instance."""
+    from transformers import AutoTokenizer
+
+    # this engine does no forking, so the batched chunk tokenization can use
+    # every core
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+    return AutoTokenizer.from_pretrained(name, use_fast=True)
+
+
+# the streams below yield (content, completion tokens) for every chunk, with
+# no content for chunks that carry no generated text
+
+
+def iter_sdk_chunks(
+    response: Iterable[Any],
+) -> Iterator[Tuple[Optional[str], Optional[int]]]:
+    for chunk in response:
+        usage = chunk.usage
+        completion_tokens = usage.completion_tokens if usage is not None else None
+        choices = chunk.choices
+        if not choices or choices[0].finish_reason not in (None, "stop"):
+            yield None, completion_tokens
+        else:
+            yield choices[0].delta.content, completion_tokens
+
+
+def iter_sse_chunks(response: Any) -> Iterator[Tuple[Optional[str], Optional[int]]]:
+    with response:
+        for line in response.iter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+
+            chunk = loads(data)
+            if "error" in chunk:
+                raise RuntimeError(chunk["error"])
+
+            usage = chunk.get("usage")
+            completion_tokens = usage.get("completion_tokens") if usage else None
+            choices = chunk.get("choices")
+            if not choices or choices[0].get("finish_reason") not in (None, "stop"):
+                yield None, completion_tokens
+            else:
+                delta = choices[0].get("delta") or {}
+                yield delta.get("content"), completion_tokens
+
+
+# without streaming, the whole response is a single chunk; a truncated
+# generation is kept, as its streamed chunks would have been
+
+
+def iter_sdk_response(response: Any) -> Iterator[Tuple[Optional[str], Optional[int]]]:
+    usage = response.usage
+    completion_tokens = usage.completion_tokens if usage is not None else None
+    choices = response.choices
+    yield choices[0].message.content if choices else None, completion_tokens
+
+
+def iter_json_response(
+    body: Dict[str, Any],
+) -> Iterator[Tuple[Optional[str], Optional[int]]]:
+    if "error" in body:
+        raise RuntimeError(body["error"])
+
+    usage = body.get("usage")
+    completion_tokens = usage.get("completion_tokens") if usage else None
+    choices = body.get("choices")
+    message = (choices[0].get("message") or {}) if choices else {}
+    yield message.get("content"), completion_tokens
 
 
 register_engine(OpenAICompatibleEngine, OpenAICompatibleConfig)
\ No newline at end of file
@@ -1,6 +1,5 @@
-import stopit
 from time import time
-from json import dumps
+from orjson import dumps
 from dataclasses import dataclass
 from typing import List, Optional, TYPE_CHECKING
 
@@ -8,7 +7,7 @@ from core.registry import register_engine
 from engines.llama_cpp import LlamaCppConfig
 from core.engine import Engine, EngineConfig
 from engines.llama_cpp import LlamaCppEngine
-from core.utils import COMPILATION_TIMEOUT, GENERATION_TIMEOUT, safe_min
+from core.utils import COMPILATION_TIMEOUT, GENERATION_TIMEOUT, alarm_timeout, safe_min
 from core.types import (
     Token,
     Schema,
@@ -28,6 +27,10 @@ if TYPE_CHECKING:
 class OutlinesConfig(EngineConfig):
     model_engine_config: LlamaCppConfig
     grammar_cache_enabled: bool = False
+    # reuse the generator of identical schemas within a run; unlike
+    # grammar_cache_enabled, the first compilation runs without the outlines
+    # cache, so its timing stays honest
+    reuse_compiled_grammars: bool = False
     max_tokens: Optional[int] = None
     hf_tokenizer_id: Optional[str] = None
 
@@ -72,34 +75,39 @@ class OutlinesEngine(Engine[OutlinesConfig]):
         input = self.formatter(messages=output.messages)
         output.token_usage.input_tokens = self.count_tokens(input)
 
+        deadline = time() + GENERATION_TIMEOUT
         try:
-            with stopit.ThreadingTimeout(GENERATION_TIMEOUT) as to_ctx_mgr:
-                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
-                    token_iterator = generator.stream(
-                        input,
-                        temperature=self.config.model_engine_config.temperature,
-                        max_tokens=safe_min(
-                            self.config.model_engine_config.n_ctx
-                            - self.count_tokens(input),
-                            self.config.max_tokens,
-                        ),
-                    )
-
-                    tokens_str = []
-                    for i, token in enumerate(token_iterator):
-                        if i == 0:
-                            output.metadata.first_token_arrival_time = time()
-                        tokens_str.append(token)
-
-                    output.metadata.decoding_status = DecodingStatus(
-                        code=DecodingStatusCode.OK
-                    )
-
-            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
+            token_iterator = generator.stream(
+                input,
+                temperature=self.config.model_engine_config.temperature,
+                max_tokens=safe_min(
+                    self.config.model_engine_config.n_ctx - self.count_tokens(input),
+                    self.config.max_tokens,
+                ),
+            )
+
+            # the deadline is checked between tokens, and the tokens generated
+            # so far are kept
+            tokens_str = []
+            timed_out = False
+            for i, token in enumerate(token_iterator):
+                if i == 0:
+                    output.metadata.first_token_arrival_time = time()
+                elif time() > deadline:
+                    timed_out = True
+                    token_iterator.close()
+                    break
+                tokens_str.append(token)
+
+            if timed_out:
                 output.metadata.decoding_status = DecodingStatus(
                     code=DecodingStatusCode.DECODING_TIMEOUT,
                     message="Generation timed out",
                 )
+            else:
+                output.metadata.decoding_status = DecodingStatus(
+                    code=DecodingStatusCode.OK
+                )
 
         except Exception as e:
             output.metadata.decoding_status = DecodingStatus(
@@ -125,35 +133,47 @@ class OutlinesEngine(Engine[OutlinesConfig]):
         from outlines.caching import cache_disabled
         from outlines.generate import json as outlines_json
 
+        reuse = self.config.grammar_cache_enabled or self.config.reuse_compiled_grammars
+        if reuse:
+            key = self.schema_fingerprint(schema)
+            generator = self._compiled_schemas.get(key)
+            if generator is not None:
+                metadata.grammar_compilation_end_time = time()
+                metadata.grammar_cached = True
+                metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
+                return generator
+
         try:
-            with stopit.ThreadingTimeout(COMPILATION_TIMEOUT) as to_ctx_mgr:
-                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
+            try:
+                with alarm_timeout(COMPILATION_TIMEOUT):
                     if not self.config.grammar_cache_enabled:
                         with cache_disabled():
                             generator = outlines_json(
-                                self.model, schema_object=dumps(schema)
+                                self.model, schema_object=dumps(schema).decode()
                             )
                     else:
                         generator = outlines_json(
-                            self.model, schema_object=dumps(schema)
+                            self.model, schema_object=dumps(schema).decode()
                         )
-
-                    metadata.grammar_compilation_end_time = time()
-                    metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
-
-            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
+            except TimeoutError:
                 metadata.compile_status = CompileStatus(
                     code=CompileStatusCode.COMPILE_TIMEOUT,
                     message="Grammar compilation timed out",
                 )
                 return None
 
+            metadata.grammar_compilation_end_time = time()
+            metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
+
         except BaseException as e:
             metadata.compile_status = CompileStatus(
                 code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(e)
             )
             return None
 
+        if reuse:
+            self._compiled_schemas[key] = generator
+
         return generator
 
     def encode(self, text: str) -> List[int]:
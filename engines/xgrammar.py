@@ -1,39 +1,158 @@
 import os
-import torch
-import stopit
-from time import time
-from json import dumps
-from dataclasses import dataclass
-from transformers.generation import LogitsProcessor
-from typing import List, Optional, TYPE_CHECKING, Dict, Any
+import queue
+import hashlib
+import threading
+from multiprocessing import Pipe, get_context
+from time import time, perf_counter, perf_counter_ns
+from pathlib import Path
+from functools import lru_cache
+from orjson import dumps
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, TYPE_CHECKING, Dict, Any, Set
 
 from core.registry import register_engine
+from engines.huggingface import load_model
 from core.engine import Engine, EngineConfig
 from core.utils import COMPILATION_TIMEOUT, GENERATION_TIMEOUT
 from core.types import (
+    Schema,
     CompileStatus,
     DecodingStatus,
     GenerationOutput,
     CompileStatusCode,
     DecodingStatusCode,
+    GenerationMetadata,
 )
 
 
+# seconds the grammar safety worker may take to load its tokenizer
+SAFETY_WORKER_STARTUP_TIMEOUT = 120
+
+
 if TYPE_CHECKING:
-    from xgrammar import GrammarCompiler
+    from xgrammar import CompiledGrammar
+    from multiprocessing.connection import Connection
+    from multiprocessing.process import BaseProcess
 
 
-class TimingLogitsProcessor(LogitsProcessor):
-    """Logits processor that records timestamps for token generation."""
+class TimingLogitsProcessor:
+    """Logits processor (duck-typed, to avoid importing transformers) that
+    records timestamps for token generation.
+    Tokens are timed with the monotonic clock and the timestamps are anchored
+    to the wall clock when read, like the generation start in profile.py."""
 
     def __init__(self):
-        super().__init__()
-        self.timestamps = []
+        self.start_time = time()
+        self.start_ns = perf_counter_ns()
+        self.timestamps_ns: List[int] = []
 
     def __call__(self, _, scores):
-        self.timestamps.append(time())
+        self.timestamps_ns.append(perf_counter_ns())
         return scores
 
+    @property
+    def timestamps(self) -> List[float]:
+        return [
+            self.start_time + (ns - self.start_ns) / 1e9 for ns in self.timestamps_ns
+        ]
+
+
+class GrammarLogitsProcessor:
+    """Logits processor (duck-typed) that masks the logits of each row with
+    the token bitmask of its grammar. The bitmask is filled on the host into
+    a pinned buffer allocated once, copied asynchronously into a device
+    buffer and applied in place by xgrammar's kernel, so the logits never
+    leave the device."""
+
+    def __init__(self, grammars: List["CompiledGrammar"]):
+        import xgrammar as xgr
+
+        self.matchers = [xgr.GrammarMatcher(grammar) for grammar in grammars]
+        self.token_bitmask = xgr.allocate_token_bitmask(
+            len(grammars), grammars[0].tokenizer_info.vocab_size
+        )
+        self.device_bitmask = None
+        self.prefilled = False
+
+    def __call__(self, input_ids, scores):
+        import xgrammar as xgr
+
+        if self.device_bitmask is None:
+            if scores.device.type == "cuda":
+                self.token_bitmask = self.token_bitmask.pin_memory()
+            self.device_bitmask = self.token_bitmask.to(scores.device)
+
+        # the first call only sees the prompt; afterwards, the last column
+        # holds the tokens sampled at the previous step
+        if self.prefilled:
+            last_tokens = input_ids[:, -1].tolist()
+            for matcher, token in zip(self.matchers, last_tokens):
+                if not matcher.is_terminated() and not matcher.accept_token(token):
+                    raise RuntimeError(f"Grammar rejected the sampled token {token}")
+        self.prefilled = True
+
+        for index, matcher in enumerate(self.matchers):
+            if not matcher.is_terminated():
+                matcher.fill_next_token_bitmask(self.token_bitmask, index)
+
+        self.device_bitmask.copy_(self.token_bitmask, non_blocking=True)
+        xgr.apply_token_bitmask_inplace(scores, self.device_bitmask)
+        return scores
+
+
+class RowStreamer:
+    """Streamer (duck-typed) that collects the tokens generated for each row
+    of a batch and hands a row back through `on_row_done` as soon as it emits
+    an end-of-sequence token, so that requests that finish early do not wait
+    for the longest one. Rows still running when generation stops are not
+    reported."""
+
+    def __init__(
+        self,
+        batch_size: int,
+        eos_token_ids: Set[int],
+        on_row_done: Callable[[int, List[int]], None],
+    ):
+        self.eos_token_ids = eos_token_ids
+        self.on_row_done = on_row_done
+        self.tokens: List[List[int]] = [[] for _ in range(batch_size)]
+        self.done = [False] * batch_size
+        self.prompt_seen = False
+
+    def put(self, value):
+        # the first call receives the prompt
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+
+        for index, token in enumerate(value.tolist()):
+            if self.done[index]:
+                continue
+            if token in self.eos_token_ids:
+                self.done[index] = True
+                self.on_row_done(index, self.tokens[index])
+            else:
+                self.tokens[index].append(token)
+
+    def end(self):
+        pass
+
+
+@dataclass
+class BatchResult:
+    status: DecodingStatus
+    first_token_arrival_time: Optional[float] = None
+    texts: Optional[List[str]] = None
+
+
+@dataclass
+class BatchRequest:
+    input: str
+    grammar: "CompiledGrammar"
+    done: threading.Event = field(default_factory=threading.Event)
+    index: int = 0
+    result: Optional[BatchResult] = None
+
 
 @dataclass
 class XGrammarConfig(EngineConfig):
@@ -41,6 +160,20 @@ class XGrammarConfig(EngineConfig):
     temperature: float = 0
     max_tokens: Optional[int] = 4096
     grammar_cache_enabled: bool = False
+    static_cache: bool = False
+    # weight-only quantization: "int8" (bitsandbytes) or "fp8" (torchao)
+    quantization: Optional[str] = None
+    # directory where compiled grammars are persisted across runs, e.g.
+    # "~/.cache/jsonschemabench/grammars"
+    grammar_cache_dir: Optional[str] = None
+    # generate concurrent requests together, see XGrammarEngine._run_batches;
+    # the reported times of a batched request include its wait for the batch
+    # to form and for the previous batch to finish, like a served request's
+    max_batch_size: int = 1
+    max_batch_wait_ms: float = 5
+    # generate in a background thread even without batching, so that the
+    # grammars of concurrent requests compile while a sample is decoding
+    pipeline_compilation: bool = False
 
 
 class XGrammarEngine(Engine[XGrammarConfig]):
@@ -50,83 +183,223 @@ class XGrammarEngine(Engine[XGrammarConfig]):
         super().__init__(config)
         add_environment_variables()
 
-        from xgrammar import TokenizerInfo, GrammarCompiler
+        from xgrammar import TokenizerInfo
         from transformers import AutoModelForCausalLM, AutoTokenizer
 
         self.tokenizer = AutoTokenizer.from_pretrained(self.config.model)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.config.model, torch_dtype=torch.bfloat16
-        ).to(get_best_device())
+        self.model = load_model(
+            AutoModelForCausalLM,
+            self.config.model,
+            get_best_device(),
+            self.config.quantization,
+        )
         self.tokenizer.pad_token = self.tokenizer.eos_token
 
-        tokenizer_info = TokenizerInfo.from_huggingface(
+        if self.config.static_cache:
+            import torch
+
+            # with a fixed-size kv cache the decoding steps keep the same
+            # shapes, so the compiled forward can replay captured graphs
+            self.model.forward = torch.compile(
+                self.model.forward, mode="reduce-overhead", fullgraph=True
+            )
+            self._warmup()
+
+        # grammars are compiled by the safety worker and loaded against this
+        # tokenizer info
+        self.tokenizer_info = tokenizer_info = TokenizerInfo.from_huggingface(
             self.tokenizer, vocab_size=self.model.config.vocab_size
         )
-        self.grammar_compiler = GrammarCompiler(
-            tokenizer_info, cache_enabled=self.config.grammar_cache_enabled
-        )
+
+        # compiled grammars depend on the vocabulary, so they are stored per
+        # tokenizer
+        self._grammar_cache_dir: Optional[Path] = None
+        if self.config.grammar_cache_dir is not None:
+            tokenizer_key = hashlib.blake2b(
+                f"{self.config.model}:{tokenizer_info.dump_metadata()}".encode(),
+                digest_size=16,
+            ).hexdigest()
+            self._grammar_cache_dir = (
+                Path(self.config.grammar_cache_dir).expanduser() / tokenizer_key
+            )
+            self._grammar_cache_dir.mkdir(parents=True, exist_ok=True)
+
+        self._safety_worker: Optional["BaseProcess"] = None
+        self._safety_lock = threading.Lock()
+        self._start_safety_worker()
+
+        # grammars are compiled by the callers and the generation is batched by
+        # a background thread, so callers may overlap; the thread pads with its
+        # own tokenizer, as a fast tokenizer can't be reconfigured while other
+        # threads encode with it
+        self._batch_queue: Optional["queue.Queue[BatchRequest]"] = None
+        self._batch_tokenizer = self.tokenizer
+        if self.config.max_batch_size > 1 or self.config.pipeline_compilation:
+            self.thread_safe = True
+            self._batch_tokenizer = AutoTokenizer.from_pretrained(self.config.model)
+            self._batch_tokenizer.pad_token = self._batch_tokenizer.eos_token
+            self._batch_tokenizer.padding_side = "left"
+            self._batch_queue = queue.Queue()
+            threading.Thread(target=self._run_batches, daemon=True).start()
+
+    def _warmup(self) -> None:
+        """Runs a couple of short generations so that compilation is not
+        counted in the first sample's timings."""
+        model_input = self.tokenizer(
+            "Hello", return_tensors="pt", add_special_tokens=False
+        ).to(self.model.device)
+        for _ in range(2):
+            self.model.generate(
+                **model_input, max_new_tokens=4, cache_implementation="static"
+            )
 
     def _generate(self, output: GenerationOutput) -> None:
-        from transformers.generation import GenerationConfig
-        from xgrammar.contrib.hf import LogitsProcessor as XGrammarLogitsProcessor
+        compiled_grammar = self._compile_grammar(output.schema, output.metadata)
+        if compiled_grammar is None:
+            return
 
-        timing_processor = TimingLogitsProcessor()
-        logits_processors = [timing_processor]
+        input = self.tokenizer.apply_chat_template(
+            output.messages, tokenize=False, add_generation_prompt=True
+        )
 
-        try:
-            json_schema_str = dumps(output.schema)
+        if self._batch_queue is None:
+            result = self._generate_batch([input], [compiled_grammar])
+            output_text = result.texts[0] if result.texts else None
+        else:
+            request = BatchRequest(input, compiled_grammar)
+            self._batch_queue.put(request)
+            request.done.wait()
+            result = request.result
+            output_text = result.texts[request.index] if result.texts else None
+
+        output.metadata.decoding_status = result.status
+        if result.first_token_arrival_time is not None:
+            output.metadata.first_token_arrival_time = result.first_token_arrival_time
+        if output_text is None:
+            return
 
-            seg_fault_check = self._check_grammar_safety(
-                self.grammar_compiler, json_schema_str, COMPILATION_TIMEOUT
-            )
-            if not seg_fault_check["success"]:
-                if "exit_code" in seg_fault_check and seg_fault_check["exit_code"] == 2:
-                    output.metadata.compile_status = CompileStatus(
-                        code=CompileStatusCode.UNSUPPORTED_SCHEMA,
-                        message="Grammar compilation timed out",
-                    )
-                    return
-                else:
-                    output.metadata.compile_status = CompileStatus(
-                        code=CompileStatusCode.UNSUPPORTED_SCHEMA,
-                        message=seg_fault_check.get(
-                            "error",
-                            f"Unknown error with exit code {seg_fault_check.get('exit_code', 'unknown')}",
-                        ),
-                    )
-                    return
-
-            with stopit.ThreadingTimeout(COMPILATION_TIMEOUT) as to_ctx_mgr:
-                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
-                    compiled_grammar = self.grammar_compiler.compile_json_schema(
-                        json_schema_str
-                    )
-
-                    output.metadata.grammar_compilation_end_time = time()
-                    output.metadata.compile_status = CompileStatus(
-                        code=CompileStatusCode.OK
-                    )
-                    logits_processors.append(XGrammarLogitsProcessor(compiled_grammar))
-
-            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
-                output.metadata.compile_status = CompileStatus(
-                    code=CompileStatusCode.COMPILE_TIMEOUT,
-                    message="Grammar compilation timed out",
-                )
-                return
+        output.generation = output_text
+        output.token_usage.output_tokens = self.count_tokens(output_text)
+
+        return
 
+    def _compile_grammar(
+        self, schema: Schema, metadata: GenerationMetadata
+    ) -> Optional["CompiledGrammar"]:
+        if self._grammar_cache_dir is not None:
+            cache_path = self._grammar_cache_dir / (
+                hashlib.blake2b(self.schema_fingerprint(schema)).hexdigest() + ".json"
+            )
+            compiled_grammar = self._load_grammar(cache_path)
+            if compiled_grammar is not None:
+                metadata.grammar_compilation_end_time = time()
+                metadata.grammar_cached = True
+                metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
+                return compiled_grammar
+
+        # the grammar is compiled by the worker process, whose deadline holds
+        # on any thread and which survives schemas that crash xgrammar
+        try:
+            result = self._compile_in_worker(
+                dumps(schema).decode(), COMPILATION_TIMEOUT
+            )
         except Exception as e:
-            output.metadata.compile_status = CompileStatus(
+            metadata.compile_status = CompileStatus(
                 code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(e)
             )
-            return
+            return None
 
-        input = self.tokenizer.apply_chat_template(
-            output.messages, tokenize=False, add_generation_prompt=True
-        )
+        if result.get("timed_out"):
+            metadata.compile_status = CompileStatus(
+                code=CompileStatusCode.COMPILE_TIMEOUT,
+                message="Grammar compilation timed out",
+            )
+            return None
+        if not result["success"]:
+            metadata.compile_status = CompileStatus(
+                code=CompileStatusCode.UNSUPPORTED_SCHEMA,
+                message=result.get(
+                    "error",
+                    f"Unknown error with exit code {result.get('exit_code', 'unknown')}",
+                ),
+            )
+            return None
 
-        model_input = self.tokenizer(
-            input,
+        compiled_grammar = result["grammar"]
+        metadata.grammar_compilation_end_time = time()
+        metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
+
+        if self._grammar_cache_dir is not None:
+            self._store_grammar(cache_path, compiled_grammar)
+
+        return compiled_grammar
+
+    def _load_grammar(self, path: Path) -> Optional["CompiledGrammar"]:
+        from xgrammar import CompiledGrammar
+
+        try:
+            return CompiledGrammar.deserialize_json(
+                path.read_text(), self.tokenizer_info
+            )
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Ignoring unreadable cached grammar {path}: {e}")
+            return None
+
+    def _store_grammar(self, path: Path, compiled_grammar: "CompiledGrammar") -> None:
+        # written to a temporary file first, so that concurrent runs never
+        # read a partially written grammar
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_text(compiled_grammar.serialize_json())
+        os.replace(tmp_path, path)
+
+    def _generate_batch(
+        self,
+        inputs: List[str],
+        grammars: List["CompiledGrammar"],
+        on_row_done: Optional[Callable[[int, BatchResult], None]] = None,
+    ) -> BatchResult:
+        """Generates completions for several prompts in one `generate` call,
+        constraining each row with its own grammar. Prompts are left-padded,
+        so all the generated tokens start at the same position.
+        Rows that finish before the others are passed to `on_row_done`, when
+        given, as soon as they end; the returned result covers every row."""
+        from transformers.generation import GenerationConfig
+
+        tokenizer = self._batch_tokenizer
+        timing_processor = TimingLogitsProcessor()
+        logits_processors = [
+            timing_processor,
+            GrammarLogitsProcessor(grammars),
+        ]
+
+        streamer = None
+        if on_row_done is not None and len(inputs) > 1:
+            eos_token_ids = self.model.generation_config.eos_token_id
+            if not isinstance(eos_token_ids, list):
+                eos_token_ids = [eos_token_ids]
+
+            def finish_row(index: int, token_ids: List[int]) -> None:
+                on_row_done(
+                    index,
+                    BatchResult(
+                        status=DecodingStatus(code=DecodingStatusCode.OK),
+                        first_token_arrival_time=timing_processor.timestamps[0],
+                        texts=[
+                            tokenizer.decode(token_ids, skip_special_tokens=True)
+                        ],
+                    ),
+                )
+
+            streamer = RowStreamer(
+                len(inputs),
+                {*eos_token_ids, tokenizer.eos_token_id} - {None},
+                finish_row,
+            )
+
+        model_input = tokenizer(
+            inputs,
             return_tensors="pt",
             add_special_tokens=False,
             padding=True,
@@ -136,89 +409,165 @@ class XGrammarEngine(Engine[XGrammarConfig]):
         input_length = model_input["input_ids"].shape[1]
 
         try:
-            with stopit.ThreadingTimeout(GENERATION_TIMEOUT) as to_ctx_mgr:
-                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
-                    model_output = self.model.generate(
-                        model_input["input_ids"],
-                        generation_config=GenerationConfig(
-                            max_new_tokens=self.config.max_tokens,
-                            temperature=self.config.temperature
-                            if self.config.temperature > 0
-                            else None,
-                            do_sample=self.config.temperature > 0,
-                            pad_token_id=self.tokenizer.eos_token_id,
-                        ),
-                        attention_mask=model_input["attention_mask"],
-                        tokenizer=self.tokenizer,
-                        logits_processor=logits_processors,
-                    )
-                    output.metadata.decoding_status = DecodingStatus(
-                        code=DecodingStatusCode.OK
-                    )
-
-            if len(timing_processor.timestamps) > 0:
-                output.metadata.first_token_arrival_time = timing_processor.timestamps[
-                    0
-                ]
-
-            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
-                output.metadata.decoding_status = DecodingStatus(
-                    code=DecodingStatusCode.DECODING_TIMEOUT,
-                    message="Generation timed out",
+            # generate stops by itself once max_time has elapsed
+            start = perf_counter()
+            model_output = self.model.generate(
+                model_input["input_ids"],
+                generation_config=GenerationConfig(
+                    max_new_tokens=self.config.max_tokens,
+                    temperature=self.config.temperature
+                    if self.config.temperature > 0
+                    else None,
+                    do_sample=self.config.temperature > 0,
+                    pad_token_id=tokenizer.eos_token_id,
+                    cache_implementation="static" if self.config.static_cache else None,
+                    max_time=GENERATION_TIMEOUT,
+                ),
+                attention_mask=model_input["attention_mask"],
+                tokenizer=tokenizer,
+                logits_processor=logits_processors,
+                streamer=streamer,
+            )
+
+            timestamps = timing_processor.timestamps
+            first_token_arrival_time = timestamps[0] if timestamps else None
+
+            if perf_counter() - start >= GENERATION_TIMEOUT:
+                return BatchResult(
+                    status=DecodingStatus(
+                        code=DecodingStatusCode.DECODING_TIMEOUT,
+                        message="Generation timed out",
+                    ),
+                    first_token_arrival_time=first_token_arrival_time,
                 )
-                return
 
         except Exception as e:
-            output.metadata.decoding_status = DecodingStatus(
-                code=DecodingStatusCode.UNKOWN_ERROR, message=str(e)
+            return BatchResult(
+                status=DecodingStatus(
+                    code=DecodingStatusCode.UNKOWN_ERROR, message=str(e)
+                )
             )
-            return
 
         generated_sequences = model_output[:, input_length:]
-        generated_texts = self.tokenizer.batch_decode(
-            generated_sequences, skip_special_tokens=True
+        return BatchResult(
+            status=DecodingStatus(code=DecodingStatusCode.OK),
+            first_token_arrival_time=first_token_arrival_time,
+            texts=tokenizer.batch_decode(
+                generated_sequences, skip_special_tokens=True
+            ),
         )
 
-        output_text = generated_texts[0] if generated_texts else ""
-
-        if timing_processor.timestamps:
-            output.metadata.first_token_arrival_time = timing_processor.timestamps[0]
-
-        output.generation = output_text
-        output.token_usage.output_tokens = self.count_tokens(output_text)
-
-        return
-
-    def _check_grammar_safety(
-        self, grammar_compiler: "GrammarCompiler", schema_str: str, timeout: int
-    ) -> Dict[str, Any]:
-        def child_process():
-            import signal
-
-            signal.signal(signal.SIGALRM, lambda _, __: os._exit(2))
-            signal.alarm(timeout)
+    def _run_batches(self) -> None:
+        """Collects concurrent requests into batches of up to `max_batch_size`
+        prompts, waiting at most `max_batch_wait_ms` for a batch to fill."""
+        max_wait = self.config.max_batch_wait_ms / 1000
+        while True:
+            requests = [self._batch_queue.get()]
+            deadline = perf_counter() + max_wait
+            while len(requests) < self.config.max_batch_size:
+                timeout = deadline - perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self._batch_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            def finish_row(index: int, result: BatchResult) -> None:
+                request = requests[index]
+                request.result = result
+                request.done.set()
+
+            result = self._generate_batch(
+                [request.input for request in requests],
+                [request.grammar for request in requests],
+                on_row_done=finish_row,
+            )
+            for index, request in enumerate(requests):
+                if request.done.is_set():
+                    continue
+                request.index = index
+                request.result = result
+                request.done.set()
+
+    def _compile_in_worker(self, schema_str: str, timeout: int) -> Dict[str, Any]:
+        """Compiles the schema in the worker process, waiting at most a few
+        seconds past `timeout` for its reply. The compiled grammar is sent
+        back serialized and loaded against this engine's tokenizer."""
+        from xgrammar import CompiledGrammar
+
+        with self._safety_lock:
+            if self._safety_worker is None or not self._safety_worker.is_alive():
+                self._start_safety_worker()
+
+            self._safety_conn.send((schema_str, timeout))
             try:
-                grammar_compiler.compile_json_schema(schema_str)
-                os._exit(0)
-            except Exception:
-                os._exit(1)
-
-        id = os.fork()
-        if id == 0:
-            child_process()
-        else:
-            _, status = os.waitpid(id, 0)
-            if os.WIFEXITED(status):
-                exit_code = os.WEXITSTATUS(status)
-                return {"success": exit_code == 0, "exit_code": exit_code}
-            elif os.WIFSIGNALED(status):
-                signal_num = os.WTERMSIG(status)
-                return {
-                    "success": False,
-                    "error": f"Process terminated by signal {signal_num}",
-                    "exit_code": -signal_num,
-                }
-            return {"success": False, "error": "Unknown status"}
+                if self._safety_conn.poll(timeout + 5):
+                    exit_code, payload = self._safety_conn.recv()
+                    if exit_code == 0:
+                        return {
+                            "success": True,
+                            "grammar": CompiledGrammar.deserialize_json(
+                                payload, self.tokenizer_info
+                            ),
+                        }
+                    return {"success": False, "exit_code": exit_code, "error": payload}
+                # the compilation is stuck where the worker's alarm can't
+                # interrupt it
+                self._stop_safety_worker()
+                result = {"success": False, "timed_out": True}
+            except EOFError:
+                # the worker crashed, or its alarm ended it
+                self._stop_safety_worker()
+                result = _safety_worker_failure(self._safety_worker.exitcode)
+
+            # the worker is replaced right away, so that loading the new
+            # worker's tokenizer is not counted in the next sample's compilation
+            self._restart_safety_worker()
+            return result
+
+    def _restart_safety_worker(self) -> None:
+        try:
+            self._start_safety_worker()
+        except Exception as e:
+            # retried before the next compilation
+            print(f"Failed to restart the grammar safety worker: {e}")
+
+    def _start_safety_worker(self) -> None:
+        # started from the fork server, so that the worker does not copy the
+        # loaded model; it only builds its own tokenizer and grammar compiler
+        self._safety_conn, child_conn = Pipe()
+        self._safety_worker = get_context("forkserver").Process(
+            target=_grammar_safety_worker,
+            args=(
+                child_conn,
+                self.config.model,
+                self.model.config.vocab_size,
+                self.config.grammar_cache_enabled,
+            ),
+            daemon=True,
+        )
+        self._safety_worker.start()
+        child_conn.close()
+        # wait until the grammar compiler is ready
+        if not self._safety_conn.poll(SAFETY_WORKER_STARTUP_TIMEOUT):
+            self._stop_safety_worker()
+            raise RuntimeError("The grammar safety worker did not start in time")
+        self._safety_conn.recv()
+
+    def _stop_safety_worker(self) -> None:
+        if self._safety_worker is None:
+            return
+        if self._safety_worker.is_alive():
+            try:
+                self._safety_conn.send(None)
+            except OSError:
+                pass
+            self._safety_worker.join(1)
+            if self._safety_worker.is_alive():
+                self._safety_worker.kill()
+        self._safety_worker.join()
+        self._safety_conn.close()
 
     def encode(self, text: str) -> List[int]:
         return self.tokenizer.encode(text, add_special_tokens=False)
@@ -230,36 +579,99 @@ class XGrammarEngine(Engine[XGrammarConfig]):
     def max_context_length(self) -> int:
         return self.tokenizer.model_max_length
 
+    def close(self):
+        self._stop_safety_worker()
+
+
+def _safety_worker_failure(exit_code: Optional[int]) -> Dict[str, Any]:
+    if exit_code == 2:
+        return {"success": False, "timed_out": True}
+    elif exit_code is not None and exit_code >= 0:
+        return {"success": False, "exit_code": exit_code}
+    elif exit_code is not None:
+        return {
+            "success": False,
+            "error": f"Process terminated by signal {-exit_code}",
+            "exit_code": exit_code,
+        }
+    return {"success": False, "error": "Unknown status"}
+
+
+def _grammar_safety_worker(
+    conn: "Connection", model: str, vocab_size: int, cache_enabled: bool
+) -> None:
+    """Compiles each received schema and replies with 0 and the serialized
+    grammar on success, or 1 and the error message. A schema that crashes
+    xgrammar takes the worker down with it, and one that hangs makes it exit
+    with code 2."""
+    import signal
+    from transformers import AutoTokenizer
+    from xgrammar import TokenizerInfo, GrammarCompiler
+
+    tokenizer = AutoTokenizer.from_pretrained(model)
+    grammar_compiler = GrammarCompiler(
+        TokenizerInfo.from_huggingface(tokenizer, vocab_size=vocab_size),
+        cache_enabled=cache_enabled,
+    )
+    conn.send(None)
+
+    signal.signal(signal.SIGALRM, lambda _, __: os._exit(2))
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+
+        schema_str, timeout = message
+        signal.alarm(timeout)
+        try:
+            reply = (0, grammar_compiler.compile_json_schema(schema_str).serialize_json())
+        except Exception as e:
+            reply = (1, str(e))
+        signal.alarm(0)
+        conn.send(reply)
+
+
+# where libcuda.so is usually installed, checked before scanning all of /usr
+LIBCUDA_DIRS = (
+    "/usr/lib/x86_64-linux-gnu",
+    "/usr/lib64",
+    "/usr/local/cuda/lib64",
+    "/usr/local/cuda/lib64/stubs",
+    "/usr/lib/wsl/lib",
+)
 
-def add_environment_variables():
-    import os
-    import subprocess
-
-    try:
-        result = subprocess.run(
-            ["find", "/usr", "-name", "libcuda.so"],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
 
-        paths = result.stdout.strip().split("\n")
+@lru_cache(maxsize=1)
+def find_libcuda_dir() -> Optional[str]:
+    for libcuda_dir in LIBCUDA_DIRS:
+        if os.path.exists(os.path.join(libcuda_dir, "libcuda.so")):
+            return libcuda_dir
+
+    path = next(Path("/usr").rglob("libcuda.so"), None)
+    return str(path.parent) if path is not None else None
 
-        if paths and paths[0]:
-            libcuda_dir = os.path.dirname(paths[0])
-            os.environ["TRITON_LIBCUDA_PATH"] = libcuda_dir
-            print(f"Set TRITON_LIBCUDA_PATH to {libcuda_dir}")
-        else:
-            print("No libcuda.so found in /usr")
 
-    except Exception as e:
-        print(f"Error setting TRITON_LIBCUDA_PATH: {e}")
+def add_environment_variables():
+    if "TRITON_LIBCUDA_PATH" not in os.environ:
+        try:
+            libcuda_dir = find_libcuda_dir()
+
+            if libcuda_dir is not None:
+                os.environ["TRITON_LIBCUDA_PATH"] = libcuda_dir
+                print(f"Set TRITON_LIBCUDA_PATH to {libcuda_dir}")
+            else:
+                print("No libcuda.so found in /usr")
+
+        except Exception as e:
+            print(f"Error setting TRITON_LIBCUDA_PATH: {e}")
 
     # Disable tokenizer parallelism to avoid deadlocks
     os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
 def get_best_device():
+    import torch
+
     if torch.cuda.is_available():
         return "cuda"
     elif torch.backends.mps.is_available():
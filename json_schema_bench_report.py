@@ -1,41 +1,37 @@
 import argparse
+import numpy as np
 import pandas as pd 
 from pathlib import Path
 
 current_dir = Path(__file__).resolve().parent
 
-def parse_mean(val):
-    try:
-        if isinstance(val, str) and "±" in val:
-            return float(val.split("±")[0].strip())
-        return float(val)
-    except:
-        return None
-    
+def parse_mean(col):
+    # values are either plain numbers or "mean ± std" strings
+    means = col.astype(str).str.split("±", n=1).str[0].str.strip()
+    return pd.to_numeric(means, errors="coerce")
+
 def parse_relevant_cols(df):
     for col in ["declared_coverage", "empirical_coverage", "compliance"]:
-        df[f"{col}_mean"] = df[col].apply(parse_mean)
+        df[f"{col}_mean"] = parse_mean(df[col])
     return df
 
 def generate_summaries(df, output_dir):
-    all_tasks = df['task'].unique()
     all_providers = df['provider'].unique()
     all_models = df['model'].unique()
-    
-    for task in all_tasks:
-        task_df = df[df['task'] == task].copy()
-        
-        full_grid = pd.MultiIndex.from_product(
-            [all_providers, all_models], names=["provider", "model"]
-        ).to_frame(index=False)
-        
+
+    full_grid = pd.MultiIndex.from_product(
+        [all_providers, all_models], names=["provider", "model"]
+    ).to_frame(index=False)
+
+    # a single pass splits the rows by task, instead of a filter per task
+    for task, task_df in df.groupby('task', sort=False):
         merged = full_grid.merge(task_df, on=["provider", "model"], how="left")
         
         for col in ["declared_coverage_mean", "empirical_coverage_mean", "compliance_mean"]:
             merged[col] = merged[col].fillna(0.0)
 
-        merged["detail"] = merged["declared_coverage"].apply(
-            lambda x: "test not ran for this model" if pd.isna(x) else ""
+        merged["detail"] = np.where(
+            merged["declared_coverage"].isna(), "test not ran for this model", ""
         )
 
 
@@ -1,12 +1,15 @@
-import json
+import os
 import pathlib
-from datetime import datetime
+import threading
+from time import perf_counter
+from datetime import datetime, timedelta
+from orjson import loads, JSONDecodeError
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 from core.bench import bench
-from core.dataset import DATASET_NAMES
-from core.utils import load_config
+from core.dataset import DATASET_NAMES, load_rows
+from core.utils import disable_print, load_config
 from engines.openai_compatible import OpenAICompatibleEngine, OpenAICompatibleConfig
 
 CURRENT_PATH = pathlib.Path(__file__).resolve().parent
@@ -14,54 +17,134 @@ CONFIG_ROOT = CURRENT_PATH / "configs"
 CONFIG_FILE_PATH = CONFIG_ROOT / "config.json"
 OUTPUT_DIR = CURRENT_PATH / "outputs"
 LIMIT = 100
+# models benchmarked at once per provider; each provider gets its own pool so
+# that one provider's rate limits don't hold up the others
+MAX_CONCURRENT_MODELS_PER_PROVIDER = 2
+# consecutive failed models after which a provider's remaining models are
+# skipped, e.g. when its API key is revoked
+MAX_CONSECUTIVE_PROVIDER_FAILURES = 2
+HEALTH_CHECK_TIMEOUT = 5
 
 def load_json_config(path):
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
+        return loads(pathlib.Path(path).read_bytes())
+    except (FileNotFoundError, JSONDecodeError) as e:
         print(f"[CONFIG] Error loading config: {e}")
     return {}
 
-def run_bench(tasks, limit, config_path, output_path):
+class CircuitBreaker:
+    """Counts the consecutive failures of a provider's models, shared by the
+    threads benchmarking them."""
+
+    def __init__(self, max_failures):
+        self.max_failures = max_failures
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    @property
+    def open(self):
+        return self.failures >= self.max_failures
+
+    def record(self, success):
+        with self.lock:
+            self.failures = 0 if success else self.failures + 1
+
+def run_bench(tasks, limit, config_path, output_path, concurrent_models=1):
+    """Returns whether the benchmark ran. `concurrent_models` is the number of
+    models of the same provider benchmarked at the same time, which share the
+    provider's `max_concurrency`."""
     try:
         config = load_config(OpenAICompatibleConfig, config_path)
         engine = OpenAICompatibleEngine(config)
-        bench(
-            engine=engine,
-            tasks=tasks,
-            limit=limit,
-            save_outputs=True,
-            close_engine=True,
-            output_path=output_path,
-        )
+        # a single one-token request fails fast on a bad key or model name,
+        # before any task spends quota
+        engine.check_health(HEALTH_CHECK_TIMEOUT)
+        # results are saved to output_path; the progress and score tables of
+        # concurrent benchmarks would only contend for the terminal
+        with disable_print():
+            bench(
+                engine=engine,
+                tasks=tasks,
+                limit=limit,
+                save_outputs=True,
+                close_engine=True,
+                output_path=output_path,
+                # the provider's request budget is split between its models
+                # running at once, so its total stays within max_concurrency
+                max_workers=max(1, config.max_concurrency // concurrent_models),
+                return_outputs=False,
+            )
+        print(f"[BENCH] Finished benchmark for config {config_path.name}")
+        return True
     except Exception as e:
         print(f"[BENCH] Error running benchmark for config {config_path.name}: {e}")
+        return False
+
+def get_datasets_to_run():
+    datasets_to_run = DATASET_NAMES.copy()
+    datasets_to_run.remove("Github_ultra")
+    return datasets_to_run
+
+def preload_datasets():
+    # every model benchmarked by this process then reuses the loaded rows; a
+    # failure here is left for the benchmarks to report
+    for dataset in get_datasets_to_run():
+        try:
+            load_rows(dataset, LIMIT)
+        except Exception as e:
+            print(f"[DATASET] Error preloading dataset {dataset}: {e}")
+
+def run_model_benchmark(provider, model, output_path, circuit_breaker, concurrent_models):
+    if circuit_breaker.open:
+        print(f"[{provider}] Skipping model {model} after repeated provider failures")
+        return
+    print(f"[{provider}] Running benchmark for model: {model}")
+    success = run_bench(
+        tasks=get_datasets_to_run(),
+        limit=LIMIT,
+        config_path=CONFIG_ROOT / model,
+        output_path=output_path,
+        concurrent_models=concurrent_models,
+    )
+    circuit_breaker.record(success)
 
 def run_provider_benchmarks(provider, models, output_path):
     provider_output_path = output_path
     provider_output_path.mkdir(parents=True, exist_ok=True)
 
-    for model in models:
-        print(f"[{provider}] Running benchmark for model: {model}")
-        datasets_to_run = DATASET_NAMES.copy()
-        datasets_to_run.remove("Github_ultra")
-        run_bench(
-            tasks=datasets_to_run,
-            limit=LIMIT,
-            config_path=CONFIG_ROOT / model,
-            output_path=provider_output_path,
-        )
+    circuit_breaker = CircuitBreaker(MAX_CONSECUTIVE_PROVIDER_FAILURES)
+    concurrent_models = max(1, min(MAX_CONCURRENT_MODELS_PER_PROVIDER, len(models)))
+    with ThreadPoolExecutor(max_workers=concurrent_models) as executor:
+        futures = [
+            executor.submit(
+                run_model_benchmark,
+                provider,
+                model,
+                provider_output_path,
+                circuit_breaker,
+                concurrent_models,
+            )
+            for model in models
+        ]
+        for future in futures:
+            future.result()
 
 def main():
     load_dotenv(CURRENT_PATH / ".env")
     config_file = load_json_config(CONFIG_FILE_PATH)
+    # the run directory is named once here and handed to every provider
+    # process, so all of a run's outputs land under the same timestamp
     current_time = datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
     output_path = OUTPUT_DIR / current_time
 
-    start_time = datetime.now()
+    start_time = perf_counter()
 
-    with ThreadPoolExecutor(max_workers=4) as executor:
+    # every provider runs concurrently in its own process, each with its own
+    # pool of models, so that clients and tokenizers don't share one GIL
+    max_workers = max(1, min(len(config_file), os.cpu_count() or 1))
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=preload_datasets
+    ) as executor:
         futures = {
             executor.submit(run_provider_benchmarks, provider, models, output_path): provider
             for provider, models in config_file.items()
@@ -74,7 +157,7 @@ def main():
             except Exception as e:
                 print(f"[{provider}] Unexpected failure in provider-level task: {e}")
 
-    delta_time = datetime.now() - start_time
+    delta_time = timedelta(seconds=perf_counter() - start_time)
     print(f"Total time taken: {delta_time}")
 
 if __name__ == "__main__":
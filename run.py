@@ -4,10 +4,12 @@ from core.bench import bench
 from argparse import ArgumentParser
 from core.dataset import DATASET_NAMES
 from core.utils import load_config, disable_print
-from core.registry import ENGINE_TO_CLASS, ENGINE_TO_CONFIG
+from core.registry import ENGINE_TO_CLASS, ENGINE_TO_CONFIG, freeze_registry
 from core.messages import FEW_SHOTS_MESSAGES_FORMATTER
 
 if __name__ == "__main__":
+    freeze_registry()
+
     parser = ArgumentParser()
     parser.add_argument(
         "--engine", type=str, required=True, choices=ENGINE_TO_CLASS.keys()
@@ -19,6 +21,23 @@ if __name__ == "__main__":
     parser.add_argument("--limit", type=int, required=False)
     parser.add_argument("--num_shots", type=int, required=False)
     parser.add_argument("--save_outputs", action="store_true")
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=8,
+        help="samples generated concurrently by thread-safe (API) engines",
+    )
+    parser.add_argument(
+        "--use_batch_api",
+        action="store_true",
+        help="submit each task as one provider batch job (openai engine only)",
+    )
+    parser.add_argument(
+        "--eval_workers",
+        type=int,
+        default=None,
+        help="processes validating the generations of a task",
+    )
     args = parser.parse_args()
 
     tasks = args.tasks
@@ -42,4 +61,7 @@ if __name__ == "__main__":
         messages_formatter=messages_formatter,
         save_outputs=args.save_outputs,
         close_engine=True,
+        max_workers=args.max_workers,
+        use_batch_api=args.use_batch_api,
+        eval_workers=args.eval_workers,
     )
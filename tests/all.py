@@ -6,73 +6,70 @@ from engines.outlines import OutlinesEngine, OutlinesConfig
 from engines.xgrammar import XGrammarEngine, XGrammarConfig
 from engines.llama_cpp import LlamaCppEngine, LlamaCppConfig
 
-# openai
-openai_engine = OpenAIEngine(OpenAIConfig(model="gpt-4o-mini"))
-bench(
-    openai_engine,
-    ["Glaiveai2K", "Github_easy", "Snowplow", "Github_medium"],
-    limit=25,
-    save_outputs=True,
-)
+TASKS = ["Glaiveai2K", "Github_easy", "Snowplow", "Github_medium"]
 
-# gemini
-gemini_engine = GeminiEngine(OpenAIConfig(model="models/gemini-2.0-flash-lite"))
-bench(
-    gemini_engine,
-    ["Glaiveai2K", "Github_easy", "Snowplow", "Github_medium"],
-    limit=25,
-    save_outputs=True,
-)
 
-# guidance
-guidance_engine = GuidanceEngine(
-    GuidanceConfig(
-        model_engine_config=LlamaCppConfig(
-            model="bartowski/Llama-3.2-1B-Instruct-GGUF", filename="*f16.gguf"
+def run_openai():
+    openai_engine = OpenAIEngine(OpenAIConfig(model="gpt-4o-mini"))
+    bench(openai_engine, TASKS, limit=25, save_outputs=True)
+
+
+def run_gemini():
+    gemini_engine = GeminiEngine(OpenAIConfig(model="models/gemini-2.0-flash-lite"))
+    bench(gemini_engine, TASKS, limit=25, save_outputs=True)
+
+
+def run_guidance():
+    guidance_engine = GuidanceEngine(
+        GuidanceConfig(
+            model_engine_config=LlamaCppConfig(
+                model="bartowski/Llama-3.2-1B-Instruct-GGUF", filename="*f16.gguf"
+            )
         )
     )
-)
-bench(
-    guidance_engine,
-    ["Glaiveai2K", "Github_easy", "Snowplow", "Github_medium"],
-    limit=25,
-    save_outputs=True,
-)
+    bench(guidance_engine, TASKS, limit=25, save_outputs=True)
 
-# llama_cpp
-llama_cpp_engine = LlamaCppEngine(
-    LlamaCppConfig(model="bartowski/Llama-3.2-1B-Instruct-GGUF", filename="*f16.gguf")
-)
-bench(
-    llama_cpp_engine,
-    ["Glaiveai2K", "Github_easy", "Snowplow", "Github_medium"],
-    limit=25,
-    save_outputs=True,
-)
 
-# outlines
-outlines_engine = OutlinesEngine(
-    OutlinesConfig(
-        model_engine_config=LlamaCppConfig(
+def run_llama_cpp():
+    llama_cpp_engine = LlamaCppEngine(
+        LlamaCppConfig(
             model="bartowski/Llama-3.2-1B-Instruct-GGUF", filename="*f16.gguf"
-        ),
-        hf_tokenizer_id="meta-llama/Llama-3.2-1B-Instruct",
+        )
+    )
+    bench(llama_cpp_engine, TASKS, limit=25, save_outputs=True)
+
+
+def run_outlines():
+    outlines_engine = OutlinesEngine(
+        OutlinesConfig(
+            model_engine_config=LlamaCppConfig(
+                model="bartowski/Llama-3.2-1B-Instruct-GGUF", filename="*f16.gguf"
+            ),
+            hf_tokenizer_id="meta-llama/Llama-3.2-1B-Instruct",
+        )
     )
-)
-bench(
-    outlines_engine,
-    ["Glaiveai2K", "Github_easy", "Snowplow", "Github_medium"],
-    limit=25,
-    save_outputs=True,
-)
+    bench(outlines_engine, TASKS, limit=25, save_outputs=True)
+
+
+def run_xgrammar():
+    xgrammar_engine = XGrammarEngine(
+        XGrammarConfig(model="meta-llama/Llama-3.2-1B-Instruct")
+    )
+    bench(xgrammar_engine, TASKS, limit=25, save_outputs=True)
+
 
-# xgrammar
-xgrammar_engine = XGrammarEngine(
-    XGrammarConfig(model="meta-llama/Llama-3.2-1B-Instruct")
-)
-bench(
-    xgrammar_engine,
-    ["Glaiveai2K", "Github_easy", "Snowplow", "Github_medium"],
-    limit=25,
-    save_outputs=True,
-)
+if __name__ == "__main__":
+    # benchmarks run one after the other: bench silences the process-wide
+    # output while generating and waits on a shared queue of result jobs, so
+    # concurrent benchmarks would hide each other's output and wait on each
+    # other's uploads; the local engines also share the GPU and rely on
+    # SIGALRM, which only works on the main thread
+    for run in (
+        run_openai,
+        run_gemini,
+        run_guidance,
+        run_llama_cpp,
+        run_outlines,
+        run_xgrammar,
+    ):
+        run()
@@ -0,0 +1,28 @@
+from core.engine import Engine
+from core.evaluator import get_validator, is_json_schema_valid, validate_json_schema
+
+BIG_INT_SCHEMA = {"type": "integer", "maximum": 2**70}
+
+
+def test_big_int_schema():
+    assert is_json_schema_valid(BIG_INT_SCHEMA)
+    assert get_validator(BIG_INT_SCHEMA) is not None
+    assert validate_json_schema(2**69, BIG_INT_SCHEMA)
+    assert not validate_json_schema(2**71, BIG_INT_SCHEMA)
+    assert Engine.schema_fingerprint(BIG_INT_SCHEMA)
+
+
+def test_generation_numbers_parse_like_json():
+    from core.types import GenerationOutput
+    from core.evaluator import _evaluate_output
+
+    for generation, schema in (
+        ("NaN", {"type": "number"}),
+        ('{"a": 1e400}', {"type": "object"}),
+        ("1180591620717411303424", {"type": "integer", "multipleOf": 2}),
+    ):
+        output = GenerationOutput(
+            task="test", messages=[], generation=generation, schema=schema
+        )
+        _, _, empirical_coverage = _evaluate_output(output)
+        assert empirical_coverage == 1, generation